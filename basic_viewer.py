@@ -1,7 +1,13 @@
-import torch
-import matplotlib.pyplot as plt
+import os
+import sys
+import logging
+import subprocess
+
 import numpy as np
 from medical_viewer import MedicalViewer
+from case_catalog import CaseCatalog
+
+# matplotlib、torch 和评估模块在首次显示 / 预测时才导入
 
 
 class BasicViewer:
@@ -10,17 +16,20 @@ class BasicViewer:
         self.fig = None
         self.current_case_loaded = None  # 跟踪当前加载的病例
 
-        # 加载模型
+        # 注册模型（权重在第一次AI预测时才读取）
         if not self.viewer.load_model():
             print("⚠️  模型加载失败，将继续使用基础功能")
 
-    def show_slice(self, case_idx=0, slice_idx=None, run_ai=False):
+    def show_slice(self, case_idx=0, slice_idx=None, run_ai=False, progressive=True):
         """显示切片，包括AI预测
         Args:
             run_ai: 是否运行AI预测，默认False避免意外触发
+            progressive: 切换病例时先显示金字塔中最粗的层级，再加载完整分辨率
         """
         # 只有在切换病例时才重新加载
         if self.current_case_loaded != case_idx:
+            if progressive:
+                self._show_overview(case_idx, slice_idx)
             case_info = self.viewer.load_case(case_idx)
             self.current_case_loaded = case_idx
             print(f"📊 加载病例: {case_info['name']}")
@@ -48,13 +57,39 @@ class BasicViewer:
         # 创建可视化
         self._create_display(ct_slice, mask_slice, ai_slice, case_info)
 
-    def _create_display(self, ct_slice, mask_slice, ai_slice, case_info):
-        """创建显示界面"""
+    def _show_overview(self, case_idx, slice_idx):
+        """立即显示低分辨率概览（没有金字塔时跳过）"""
+        from resolution_pyramid import available_factors
+
+        case_names = self.viewer.case_names
+        if not 0 <= case_idx < len(case_names):
+            return
+        factors = available_factors(case_names[case_idx], self.viewer.data_dir)
+        if not factors:
+            return
+        case_info = self.viewer.load_case(case_idx, factor=factors[0])
+        ct_slice, mask_slice = self.viewer.get_slice(slice_idx)
+        self._create_display(ct_slice, mask_slice, None, case_info, block=False)
+
+    def _create_display(self, ct_slice, mask_slice, ai_slice, case_info, block=True):
+        """创建显示界面
+
+        Args:
+            block: False 时非阻塞显示（用于渐进式加载的概览）
+        """
+        import matplotlib.pyplot as plt
+
+        # 关闭上一个窗口（例如渐进式加载时的概览）
+        if self.fig is not None:
+            plt.close(self.fig)
         self.fig, axes = plt.subplots(2, 2, figsize=(12, 10))
 
         # CT扫描
         axes[0, 0].imshow(ct_slice, cmap='gray', aspect='auto')
-        axes[0, 0].set_title(f'CT Scan - Slice {self.viewer.current_slice}')
+        title = f'CT Scan - Slice {self.viewer.current_slice}'
+        if case_info and case_info.get('factor', 1) > 1:
+            title += f" (x{case_info['factor']} overview)"
+        axes[0, 0].set_title(title)
         axes[0, 0].axis('off')
 
         # 医生标注 (带颜色)
@@ -85,7 +120,11 @@ class BasicViewer:
             axes[1, 1].axis('off')
 
         plt.tight_layout()
-        plt.show()
+        if block:
+            plt.show()
+        else:
+            plt.show(block=False)
+            plt.pause(0.001)
 
     def _colorize_mask(self, mask):
         """将分割掩码转换为彩色"""
@@ -96,14 +135,20 @@ class BasicViewer:
                            [0, 0, 1, 0.7]])  # 蓝色-囊肿
         return colors[mask]
 
-    def list_cases(self):
-        """列出所有可用病例（不重复加载）"""
-        total_cases = len(self.viewer.dataset)
-        print(f"📁 Available cases: {total_cases}")
-
-        # 只显示信息，不实际加载数据
-        for i in range(min(5, total_cases)):
-            print(f"  {i}: case_{i:05d}")
+    def list_cases(self, limit=5):
+        """列出所有可用病例（不加载体积，也不导入 torch）"""
+        case_names = self.viewer.case_names
+        catalog_path = f"{self.viewer.data_dir}/catalog.sqlite"
+        if os.path.exists(catalog_path):
+            catalog = CaseCatalog(catalog_path)
+            catalog.print_summary(case_names, limit)
+            catalog.close()
+            return
+
+        # 没有病例目录时只显示名称
+        print(f"📁 Available cases: {len(case_names)}")
+        for i, name in enumerate(case_names[:limit]):
+            print(f"  {i}: {name}")
 
     def compare_annotations(self, case_idx=0, slice_idx=64):
         """对比医生标注和AI预测"""
@@ -127,11 +172,24 @@ class BasicViewer:
         print(f"👨‍⚕️ 医生标注 - 类别分布: {doctor_stats}")
         print(f"🤖 AI预测 - 类别分布: {ai_stats}")
 
+        # 整个病例的逐类别指标
+        if self.viewer.ai_mask is not None:
+            from evaluate_segmentation import evaluate_case
+
+            spacing = self.viewer.get_case_spacing()
+            unit = "mm" if spacing is not None else "体素"
+            case_metrics = evaluate_case(self.viewer.mask, self.viewer.ai_mask, spacing=spacing)
+            for class_name, m in case_metrics.items():
+                print(f"📐 {class_name}: Dice={m['dice']:.3f}, IoU={m['iou']:.3f}, "
+                      f"体积误差={m['volume_error']:.3f}, HD95={m['hd95']:.2f}{unit}, ASSD={m['assd']:.2f}{unit}")
+
         # 可视化对比
         self._create_comparison_display(ct_slice, doctor_mask, ai_mask)
 
     def _create_comparison_display(self, ct_slice, doctor_mask, ai_mask):
         """创建详细对比显示"""
+        import matplotlib.pyplot as plt
+
         fig, axes = plt.subplots(2, 3, figsize=(15, 10))
 
         # 第一行：单独显示
@@ -174,8 +232,54 @@ class BasicViewer:
         plt.show()
 
 
+# 在全新的解释器中测量，避免已导入的模块影响结果
+_COLD_START_CODE = """
+import sys, time
+start = time.perf_counter()
+from basic_viewer import BasicViewer
+imported = time.perf_counter()
+viewer = BasicViewer()
+constructed = time.perf_counter()
+viewer.list_cases(limit=1)
+listed = time.perf_counter()
+torch_loaded = 'torch' in sys.modules
+viewer.show_slice(case_idx={case_idx})
+shown = time.perf_counter()
+print(imported - start, constructed - start, listed - start, shown - start, torch_loaded, file=sys.stderr)
+"""
+
+
+def benchmark_cold_start(repeats=3, case_idx=0):
+    """测量冷启动：导入、构建查看器、列出病例、显示第一张切片（Agg 后端，不弹窗）
+
+    Returns:
+        dict: 各阶段从导入开始计时的中位数（秒），以及列出病例时是否已导入 torch
+    """
+    env = dict(os.environ, MPLBACKEND='Agg')
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                      env.get('PYTHONPATH')]))
+    stages = ('import', 'construct', 'list_cases', 'first_slice')
+    runs = []
+    for _ in range(repeats):
+        proc = subprocess.run([sys.executable, "-c", _COLD_START_CODE.format(case_idx=case_idx)],
+                              env=env, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"❌ 冷启动测量失败: {proc.stderr.strip().splitlines()[-1:]}")
+            return None
+        runs.append(proc.stderr.strip().splitlines()[-1].split())
+
+    result = {stage: float(np.median([float(run[i]) for run in runs])) for i, stage in enumerate(stages)}
+    result['torch_imported_at_list'] = runs[-1][4] == 'True'
+    print(f"⏱️  冷启动 (中位数, {repeats} 次): 导入 {result['import']:.2f}s, "
+          f"构建 {result['construct']:.2f}s, 列出病例 {result['list_cases']:.2f}s, "
+          f"第一张切片 {result['first_slice']:.2f}s")
+    print(f"   列出病例时已导入 torch: {'是' if result['torch_imported_at_list'] else '否'}")
+    return result
+
+
 # 使用示例
 if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("KITS23_LOG_LEVEL", "WARNING"), format="%(message)s")
     viewer = BasicViewer()
     viewer.compare_annotations(case_idx=0, slice_idx=64)
     viewer.list_cases()
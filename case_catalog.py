@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+KITS23 病例目录 - SQLite 持久化索引
+预处理时增量写入每个病例的元数据（形状、各标签体素数、ROI 范围、原始间距、内容哈希），
+数据集、查看器和划分工具直接查询，不再需要加载整个体积
+"""
+import os
+import glob
+import time
+import random
+import hashlib
+import sqlite3
+
+LABEL_NAMES = ('background', 'kidney', 'tumor', 'cyst')
+
+COLUMNS = [
+    ('case_name', 'TEXT PRIMARY KEY'),
+    ('file_path', 'TEXT'),
+    ('source_path', 'TEXT'),
+    ('source_size', 'INTEGER'),
+    ('source_mtime', 'REAL'),
+    ('source_hash', 'TEXT'),
+    ('content_hash', 'TEXT'),
+    ('depth', 'INTEGER'),
+    ('height', 'INTEGER'),
+    ('width', 'INTEGER'),
+    ('original_depth', 'INTEGER'),
+    ('original_height', 'INTEGER'),
+    ('original_width', 'INTEGER'),
+    ('spacing_z', 'REAL'),
+    ('spacing_y', 'REAL'),
+    ('spacing_x', 'REAL'),
+    ('roi_start', 'INTEGER'),
+    ('roi_end', 'INTEGER'),
+] + [(f'voxels_{name}', 'INTEGER') for name in LABEL_NAMES] + [
+    ('tumor_volume_ml', 'REAL'),
+    ('updated_at', 'REAL'),
+]
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """流式计算文件的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sources_hash(paths):
+    """多个源文件（影像 + 分割）的组合哈希"""
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(file_hash(path).encode())
+    return digest.hexdigest()
+
+
+def _sources_stat(paths):
+    """组合大小与最新修改时间，用于快速判断源文件是否变化"""
+    stats = [os.stat(p) for p in paths]
+    return sum(s.st_size for s in stats), max(s.st_mtime for s in stats)
+
+
+def build_record(case_name, file_path, segmentation, info=None, source_paths=None):
+    """由预处理结果生成一条目录记录
+
+    Args:
+        segmentation: 预处理后的分割 [1, D, H, W] (torch.Tensor)
+        info: KITS23Preprocessor.preprocess(return_info=True) 返回的信息
+        source_paths: [影像路径, 分割路径]
+    """
+    import torch
+
+    depth, height, width = segmentation.shape[-3:]
+    counts = torch.bincount(segmentation.flatten().long(), minlength=len(LABEL_NAMES)).tolist()
+    record = {
+        'case_name': case_name,
+        'file_path': file_path,
+        'content_hash': file_hash(file_path),
+        'depth': depth,
+        'height': height,
+        'width': width,
+        'updated_at': time.time(),
+    }
+    for name, count in zip(LABEL_NAMES, counts):
+        record[f'voxels_{name}'] = int(count)
+
+    if source_paths:
+        size, mtime = _sources_stat(source_paths)
+        record.update({
+            'source_path': source_paths[0],
+            'source_size': size,
+            'source_mtime': mtime,
+            'source_hash': sources_hash(source_paths),
+        })
+
+    if info is not None:
+        original_depth, original_height, original_width = info['original_shape'][:3]
+        spacing_z, spacing_y, spacing_x = [float(s) for s in info['spacing'][:3]]
+        roi_start, roi_end = info['roi'] if info['roi'] else (0, original_depth)
+        record.update({
+            'original_depth': original_depth,
+            'original_height': original_height,
+            'original_width': original_width,
+            'spacing_z': spacing_z,
+            'spacing_y': spacing_y,
+            'spacing_x': spacing_x,
+            'roi_start': int(roi_start),
+            'roi_end': int(roi_end),
+        })
+        spacing_d, spacing_h, spacing_w = effective_spacing(record)
+        record['tumor_volume_ml'] = record['voxels_tumor'] * spacing_d * spacing_h * spacing_w / 1000.0
+
+    return record
+
+
+def ordered_case_names(data_dir="preprocessed_data"):
+    """预处理病例的稳定顺序：先按目录中的顺序，再追加未索引的文件（按名称排序）
+
+    只读取目录和文件名，不导入 torch
+    """
+    on_disk = {os.path.splitext(os.path.basename(f))[0] for f in glob.glob(f"{data_dir}/*.pt")}
+    catalog_path = f"{data_dir}/catalog.sqlite"
+    if not os.path.exists(catalog_path):
+        return sorted(on_disk)
+    catalog = CaseCatalog(catalog_path)
+    indexed = catalog.case_names()
+    catalog.close()
+    unindexed = sorted(on_disk.difference(indexed))
+    if unindexed:
+        print(f"⚠️  {len(unindexed)} 个病例未在目录中索引 (运行 python case_catalog.py 补建)")
+    return [name for name in indexed if name in on_disk] + unindexed
+
+
+def effective_spacing(record):
+    """预处理后体积的体素间距 (D, H, W)，单位 mm
+
+    ROI 被重采样到 depth 张切片、面内缩放到 height×width，每个病例的间距都不同；
+    没有原始数据信息的记录返回 None
+    """
+    if record is None or record.get('spacing_z') is None:
+        return None
+    roi_length = record['roi_end'] - record['roi_start']
+    return (record['spacing_z'] * roi_length / record['depth'],
+            record['spacing_y'] * record['original_height'] / record['height'],
+            record['spacing_x'] * record['original_width'] / record['width'])
+
+
+class CaseCatalog:
+    """病例元数据的 SQLite 索引"""
+
+    def __init__(self, db_path="preprocessed_data/catalog.sqlite"):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        columns = ", ".join(f"{name} {kind}" for name, kind in COLUMNS)
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS cases ({columns})")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM cases").fetchone()[0]
+
+    def upsert(self, record):
+        """插入或更新一条记录（只更新给出的字段）"""
+        names = list(record.keys())
+        placeholders = ", ".join("?" for _ in names)
+        updates = ", ".join(f"{n}=excluded.{n}" for n in names if n != 'case_name')
+        self.conn.execute(
+            f"INSERT INTO cases ({', '.join(names)}) VALUES ({placeholders}) "
+            f"ON CONFLICT(case_name) DO UPDATE SET {updates}",
+            [record[n] for n in names])
+        self.conn.commit()
+
+    def get(self, case_name):
+        row = self.conn.execute("SELECT * FROM cases WHERE case_name = ?", (case_name,)).fetchone()
+        return dict(row) if row else None
+
+    def remove(self, case_name):
+        self.conn.execute("DELETE FROM cases WHERE case_name = ?", (case_name,))
+        self.conn.commit()
+
+    def query(self, where=None, params=()):
+        """按 case_name 排序返回记录（稳定顺序）"""
+        sql = "SELECT * FROM cases"
+        if where:
+            sql += f" WHERE {where}"
+        sql += " ORDER BY case_name"
+        return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def case_names(self):
+        return [row[0] for row in self.conn.execute("SELECT case_name FROM cases ORDER BY case_name")]
+
+    def is_up_to_date(self, case_name, source_paths, output_path):
+        """源文件未变化且输出文件存在时，预处理可以跳过
+
+        先比较大小和修改时间，只有不一致时才计算哈希
+        """
+        record = self.get(case_name)
+        if record is None or not os.path.exists(output_path) or record['source_hash'] is None:
+            return False
+        size, mtime = _sources_stat(source_paths)
+        if size == record['source_size'] and mtime == record['source_mtime']:
+            return True
+        if sources_hash(source_paths) == record['source_hash']:
+            self.upsert({'case_name': case_name, 'source_size': size, 'source_mtime': mtime})
+            return True
+        return False
+
+    def index_preprocessed(self, data_dir="preprocessed_data"):
+        """为已有的预处理文件补建索引（没有原始数据信息）"""
+        import torch
+
+        indexed = 0
+        for path in sorted(glob.glob(f"{data_dir}/*.pt")):
+            case_name = os.path.splitext(os.path.basename(path))[0]
+            record = self.get(case_name)
+            if record is not None and record['content_hash'] == file_hash(path):
+                continue
+            data = torch.load(path)
+            self.upsert(build_record(case_name, path, data['segmentation']))
+            indexed += 1
+            print(f"📇 已索引: {case_name}")
+        return indexed
+
+    def stratified_split(self, val_fraction=0.2, seed=42):
+        """按 (是否有肿瘤, 是否有囊肿) 分层划分训练/验证集，结果与插入顺序无关
+
+        Returns:
+            (train_names, val_names)
+        """
+        strata = {}
+        for record in self.query():
+            key = (record['voxels_tumor'] > 0, record['voxels_cyst'] > 0)
+            strata.setdefault(key, []).append(record['case_name'])
+
+        rng = random.Random(seed)
+        train, val = [], []
+        for key in sorted(strata):
+            names = sorted(strata[key])
+            rng.shuffle(names)
+            n_val = int(round(len(names) * val_fraction))
+            val.extend(names[:n_val])
+            train.extend(names[n_val:])
+        return sorted(train), sorted(val)
+
+    def print_summary(self, case_names=None, limit=None):
+        """不加载体积，直接打印病例列表
+
+        Args:
+            case_names: 按该顺序打印（例如数据集的病例顺序），默认为目录中全部病例
+        """
+        if case_names is None:
+            case_names = self.case_names()
+        print(f"📁 Available cases: {len(case_names)}")
+        for i, name in enumerate(case_names[:limit] if limit else case_names):
+            r = self.get(name)
+            if r is None:
+                print(f"  {i}: {name}  (未索引)")
+                continue
+            labels = [label for label in LABEL_NAMES[1:] if r[f'voxels_{label}']]
+            tumor = f"{r['tumor_volume_ml']:.1f} ml" if r['tumor_volume_ml'] is not None else "n/a"
+            roi = f"[{r['roi_start']}-{r['roi_end']}]" if r['roi_start'] is not None else "n/a"
+            print(f"  {i}: {name}  {r['depth']}×{r['height']}×{r['width']}  "
+                  f"标签: {','.join(labels) or '无'}  肿瘤体积: {tumor}  ROI: {roi}")
+
+if __name__ == "__main__":
+    catalog = CaseCatalog()
+    print(f"🔄 补建索引: 新增 {catalog.index_preprocessed()} 个病例")
+    catalog.print_summary()
+    train_names, val_names = catalog.stratified_split()
+    print(f"📊 分层划分: 训练 {len(train_names)} / 验证 {len(val_names)}")
@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
 import torch
-import glob
 from torch.utils.data import Dataset, DataLoader
+from case_catalog import ordered_case_names
 
 class KITS23Dataset(Dataset):
-    def __init__(self, data_dir="preprocessed_data"):
-        self.files = glob.glob(f"{data_dir}/*.pt")
+    def __init__(self, data_dir="preprocessed_data", cases=None, patch_size=None, random_crop=True):
+        """
+        Args:
+            cases: 只使用这些病例名（例如 CaseCatalog.stratified_split 的结果）
+            patch_size: (D, H, W)，给出时裁剪该尺寸的子块（例如 MemoryPlanner.plan_training 的结果）
+            random_crop: True 时每次随机裁剪（训练）；False 时固定取中心子块，
+                         每次访问结果相同（验证损失可以跨 epoch 比较）
+        """
+        self.data_dir = data_dir
+        self.patch_size = tuple(patch_size) if patch_size else None
+        self.random_crop = random_crop
+        # 病例目录提供稳定的顺序；不保留连接，数据集可以被 DataLoader 进程序列化
+        self.case_names = ordered_case_names(data_dir)
+        if cases is not None:
+            wanted = set(cases)
+            self.case_names = [name for name in self.case_names if name in wanted]
+        self.files = [f"{data_dir}/{name}.pt" for name in self.case_names]
         print(f"📁 加载 {len(self.files)} 个预处理病例")
     
     def __len__(self):
@@ -13,7 +28,17 @@ class KITS23Dataset(Dataset):
     
     def __getitem__(self, idx):
         data = torch.load(self.files[idx])
-        return data['image'], data['segmentation']
+        image, segmentation = data['image'], data['segmentation']
+        if self.patch_size is not None:
+            region = [slice(None)]
+            for size, patch in zip(image.shape[-3:], self.patch_size):
+                if self.random_crop:
+                    start = int(torch.randint(0, max(1, size - patch + 1), ()))
+                else:
+                    start = max(0, (size - patch) // 2)
+                region.append(slice(start, start + patch))
+            image, segmentation = image[tuple(region)], segmentation[tuple(region)]
+        return image, segmentation
 
 # 测试
 if __name__ == "__main__":
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+KITS23 分割评估 - 整个队列的逐类别指标
+Dice / IoU / 体积误差 来自一次 bincount 混淆矩阵
+Hausdorff95 / ASSD 的距离变换只在标签包围盒内计算
+"""
+import os
+import csv
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from scipy import ndimage
+
+LABELS = {
+    0: "background",
+    1: "kidney",
+    2: "tumor",
+    3: "cyst"
+}
+
+METRIC_FIELDS = ['dice', 'iou', 'volume_error', 'hd95', 'assd']
+SURFACE_FIELDS = ['hd95', 'assd']
+
+# HD95 / ASSD 的单位：有体素间距时为 mm，否则为体素
+UNIT_NAMES = {'mm': 'mm', 'voxel': '体素'}
+
+
+def confusion_matrix(gt, pred, num_classes=4, chunk_depth=16):
+    """按深度分块做 bincount，得到 [gt, pred] 混淆矩阵
+
+    gt*num_classes + pred 在 uint8 内计算，每块只展开 chunk_depth 张切片，
+    避免为 128×512×512 体积一次性生成 int64 索引数组
+    """
+    gt = np.asarray(gt)
+    pred = np.asarray(pred)
+    if gt.shape != pred.shape:
+        raise ValueError(f"形状不一致: gt {gt.shape} vs pred {pred.shape}")
+
+    code_dtype = np.uint8 if num_classes * num_classes <= 256 else np.int64
+    cm = np.zeros(num_classes * num_classes, dtype=np.int64)
+    for z in range(0, gt.shape[0], chunk_depth):
+        code = gt[z:z + chunk_depth].astype(code_dtype) * num_classes
+        code += pred[z:z + chunk_depth].astype(code_dtype)
+        cm += np.bincount(code.ravel(), minlength=num_classes * num_classes)
+    return cm.reshape(num_classes, num_classes)
+
+
+def overlap_metrics(cm):
+    """从混淆矩阵计算每个类别的 Dice / IoU / 体积误差（向量化）"""
+    cm = cm.astype(np.float64)
+    tp = np.diag(cm)
+    gt_vol = cm.sum(axis=1)
+    pred_vol = cm.sum(axis=0)
+    fp = pred_vol - tp
+    fn = gt_vol - tp
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dice = 2 * tp / (2 * tp + fp + fn)
+        iou = tp / (tp + fp + fn)
+        volume_error = (pred_vol - gt_vol) / gt_vol
+
+    return {
+        'dice': dice,
+        'iou': iou,
+        'volume_error': volume_error,
+        'gt_voxels': gt_vol.astype(np.int64),
+        'pred_voxels': pred_vol.astype(np.int64),
+    }
+
+
+def _bounding_box(mask, pad=1):
+    """返回 mask 的包围盒切片（带 pad 个体素缓冲），空 mask 返回 None"""
+    coords = []
+    for axis in range(mask.ndim):
+        other = tuple(a for a in range(mask.ndim) if a != axis)
+        present = np.where(np.any(mask, axis=other))[0]
+        if len(present) == 0:
+            return None
+        start = max(0, present[0] - pad)
+        end = min(mask.shape[axis], present[-1] + pad + 1)
+        coords.append(slice(start, end))
+    return tuple(coords)
+
+
+def _surface(mask):
+    """表面体素 = mask 减去其腐蚀"""
+    return mask & ~ndimage.binary_erosion(mask)
+
+
+def surface_metrics(gt_mask, pred_mask, spacing=None):
+    """计算单个类别的 Hausdorff95 和 ASSD
+
+    距离变换只在 gt ∪ pred 的包围盒内进行。两个表面都在盒内，
+    所以到最近表面点的距离与全体积计算结果一致。
+
+    Returns:
+        (hd95, assd): 两者都为空时为 nan，只有一方为空时为 inf
+    """
+    union = gt_mask | pred_mask
+    box = _bounding_box(union)
+    if box is None:
+        return np.nan, np.nan
+    gt_box = gt_mask[box]
+    pred_box = pred_mask[box]
+    if not gt_box.any() or not pred_box.any():
+        return np.inf, np.inf
+
+    gt_surface = _surface(gt_box)
+    pred_surface = _surface(pred_box)
+
+    dist_to_gt = ndimage.distance_transform_edt(~gt_surface, sampling=spacing)
+    dist_to_pred = ndimage.distance_transform_edt(~pred_surface, sampling=spacing)
+
+    pred_to_gt = dist_to_gt[pred_surface]
+    gt_to_pred = dist_to_pred[gt_surface]
+
+    hd95 = max(np.percentile(pred_to_gt, 95), np.percentile(gt_to_pred, 95))
+    assd = (pred_to_gt.sum() + gt_to_pred.sum()) / (len(pred_to_gt) + len(gt_to_pred))
+    return float(hd95), float(assd)
+
+
+def evaluate_case(gt, pred, num_classes=4, spacing=None, surface=True):
+    """计算一个病例所有前景类别的指标
+
+    Returns:
+        dict: {类别名: {dice, iou, volume_error, hd95, assd, gt_voxels, pred_voxels}}
+    """
+    gt = np.asarray(gt)
+    pred = np.asarray(pred)
+    overlap = overlap_metrics(confusion_matrix(gt, pred, num_classes))
+
+    results = {}
+    for label in range(1, num_classes):
+        name = LABELS.get(label, f"class_{label}")
+        metrics = {key: overlap[key][label] for key in overlap}
+        if surface:
+            metrics['hd95'], metrics['assd'] = surface_metrics(gt == label, pred == label, spacing)
+        else:
+            metrics['hd95'], metrics['assd'] = np.nan, np.nan
+        results[name] = metrics
+    return results
+
+
+def _evaluate_job(case_name, gt, pred, num_classes, spacing, surface):
+    """进程池任务：返回该病例的表格行"""
+    start = time.time()
+    results = evaluate_case(gt, pred, num_classes, spacing, surface)
+    elapsed = time.time() - start
+
+    rows = []
+    for class_name, metrics in results.items():
+        row = {'case': case_name, 'class': class_name}
+        row.update({key: int(value) if key.endswith('_voxels') else float(value)
+                    for key, value in metrics.items()})
+        row['units'] = 'voxel' if spacing is None else 'mm'
+        row['seconds'] = round(elapsed, 3)
+        rows.append(row)
+    return rows
+
+
+class CohortEvaluator:
+    """整个队列的并行评估器
+
+    预测在主进程中产生（模型推理本身已经多线程），
+    指标计算分发到进程池，完成一个病例就写一批 CSV 行。
+    """
+
+    FIELDNAMES = ['case', 'class'] + METRIC_FIELDS + ['units', 'gt_voxels', 'pred_voxels', 'seconds']
+
+    def __init__(self, num_classes=4, num_workers=None, spacing=None, surface=True):
+        self.num_classes = num_classes
+        self.num_workers = num_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.spacing = spacing
+        self.surface = surface
+
+    def evaluate(self, cases, output_csv="evaluation/metrics.csv"):
+        """
+        Args:
+            cases: 可迭代的 (case_name, gt, pred) 或 (case_name, gt, pred, spacing)，按需生成，
+                   同时在途的病例数受进程池大小限制；逐病例的 spacing 优先于 self.spacing
+            output_csv: 逐行写入的结果表
+        Returns:
+            list: 所有结果行
+        """
+        os.makedirs(os.path.dirname(output_csv) or '.', exist_ok=True)
+        all_rows = []
+        max_pending = self.num_workers * 2
+
+        with open(output_csv, 'w', newline='') as f, \
+                ProcessPoolExecutor(max_workers=self.num_workers) as pool:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDNAMES)
+            writer.writeheader()
+
+            def drain(pending, block):
+                done = [fut for fut in pending if fut.done()]
+                if block and not done:
+                    done = [next(as_completed(pending))]
+                for fut in done:
+                    pending.remove(fut)
+                    rows = fut.result()
+                    writer.writerows(rows)
+                    f.flush()
+                    all_rows.extend(rows)
+                    print(f"✅ {rows[0]['case']}: " + ", ".join(
+                        f"{r['class']} Dice={r['dice']:.3f}" for r in rows))
+
+            pending = set()
+            voxel_unit_cases = 0
+            for case_name, gt, pred, *case_spacing in cases:
+                spacing = case_spacing[0] if case_spacing and case_spacing[0] is not None else self.spacing
+                if spacing is None:
+                    voxel_unit_cases += 1
+                pending.add(pool.submit(_evaluate_job, case_name, gt, pred,
+                                        self.num_classes, spacing, self.surface))
+                # 限制在途病例数，避免所有体积同时驻留内存
+                while len(pending) >= max_pending:
+                    drain(pending, block=True)
+            while pending:
+                drain(pending, block=True)
+
+        print(f"📁 评估结果保存在: {output_csv}")
+        if voxel_unit_cases and self.surface:
+            print(f"⚠️  {voxel_unit_cases} 个病例没有体素间距，HD95/ASSD 以体素为单位，与 mm 值分开汇总")
+        self.print_summary(all_rows)
+        return all_rows
+
+    @staticmethod
+    def print_summary(rows):
+        """打印每个类别的平均指标（忽略 nan/inf），并给出被排除的病例数
+
+        只有一方为空（漏检或误检）时 HD95/ASSD 为 inf，不计入均值，
+        所以必须同时查看漏检数，否则漏掉整个肿瘤反而会让 HD95 看起来更好。
+        HD95/ASSD 按单位（mm / 体素）分组求均值，不同单位的病例不混在一起平均
+        """
+        if not rows:
+            print("⚠️  没有评估结果")
+            return
+
+        def mean_text(class_rows, key):
+            column = np.array([r[key] for r in class_rows], dtype=np.float64)
+            column = column[np.isfinite(column)]
+            return f"{key}={column.mean():.3f}" if len(column) else f"{key}=n/a"
+
+        print(f"\n{'='*50}")
+        print("📊 队列平均指标:")
+        for class_name in dict.fromkeys(r['class'] for r in rows):
+            class_rows = [r for r in rows if r['class'] == class_name]
+            print(f"  {class_name}: " + ", ".join(mean_text(class_rows, key)
+                                                 for key in METRIC_FIELDS if key not in SURFACE_FIELDS))
+            for units in dict.fromkeys(r['units'] for r in class_rows):
+                unit_rows = [r for r in class_rows if r['units'] == units]
+                print(f"    {UNIT_NAMES[units]} ({len(unit_rows)} 例): " +
+                      ", ".join(mean_text(unit_rows, key) for key in SURFACE_FIELDS))
+            missed = sum(1 for r in class_rows if r['gt_voxels'] > 0 and r['pred_voxels'] == 0)
+            spurious = sum(1 for r in class_rows if r['gt_voxels'] == 0 and r['pred_voxels'] > 0)
+            empty = sum(1 for r in class_rows if r['gt_voxels'] == 0 and r['pred_voxels'] == 0)
+            print(f"    漏检 {missed}/{len(class_rows)}, 误检 {spurious}, 两者皆空 {empty} "
+                  f"(这些病例的 HD95/ASSD 不计入均值)")
+
+
+def iter_model_predictions(viewer):
+    """用 MedicalViewer 依次预测每个病例，生成 (case_name, gt, pred, spacing)"""
+    for idx in range(len(viewer.case_names)):
+        if viewer.load_case(idx) is None:
+            continue
+        if not viewer.run_ai_prediction():
+            continue
+        case_name = viewer.get_case_info()['name']
+        yield (case_name, viewer.mask.astype(np.uint8), viewer.ai_mask.astype(np.uint8),
+               viewer.get_case_spacing())
+
+
+def evaluate_all(output_csv="evaluation/metrics.csv", num_workers=None):
+    """对所有预处理病例运行模型并评估"""
+    from medical_viewer import MedicalViewer
+
+    print("🚀 开始队列评估...")
+    viewer = MedicalViewer()
+    if not viewer.load_model():
+        print("❌ 无法加载模型，评估中止")
+        return []
+
+    evaluator = CohortEvaluator(num_workers=num_workers)
+    return evaluator.evaluate(iter_model_predictions(viewer), output_csv)
+
+
+if __name__ == "__main__":
+    evaluate_all()
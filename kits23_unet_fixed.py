@@ -2,15 +2,22 @@
 """
 修复的 KITS23 UNet - 立即下采样输入
 """
+import time
+import pickle
+import logging
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+# 形状等调试信息走 logging，默认 WARNING 级别下不格式化也不输出
+logger = logging.getLogger(__name__)
+
 class KITS23UNetFixed(nn.Module):
     def __init__(self, in_channels=1, out_channels=4):
         super().__init__()
         
-        print("🧠 初始化修复的 KITS23 UNet...")
+        logger.debug("🧠 初始化修复的 KITS23 UNet...")
         
         # 关键修复：在第一个卷积前立即下采样
         self.initial_downsample = nn.Sequential(
@@ -40,11 +47,14 @@ class KITS23UNetFixed(nn.Module):
         )
     
     def forward(self, x):
-        print(f"📥 原始输入: {x.shape}")
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("📥 原始输入: %s", x.shape)
         
         # 关键修复：立即处理大尺寸输入
         x = self.initial_downsample(x)  # [B, 16, 64, 256, 256]
-        print(f"📤 下采样后: {x.shape}")
+        if debug:
+            logger.debug("📤 下采样后: %s", x.shape)
         
         # Encoder
         e1 = self.enc1(x)              # [B, 32, 64, 256, 256]
@@ -66,10 +76,71 @@ class KITS23UNetFixed(nn.Module):
         
         # 上采样回原始尺寸
         output = self.final_upsample(d3)  # [B, 4, 128, 512, 512]
-        print(f"📦 最终输出: {output.shape}")
+        if debug:
+            logger.debug("📦 最终输出: %s", output.shape)
         
         return output
 
+def load_checkpoint(model_path, map_location='cpu'):
+    """通过内存映射读取检查点，张量直接引用文件页而不是先完整复制一份
+
+    旧版 torch (<2.1) 或旧的非 zip 格式不支持 mmap / weights_only 时回退到普通加载
+    """
+    try:
+        return torch.load(model_path, map_location=map_location, mmap=True, weights_only=True)
+    except (TypeError, RuntimeError, pickle.UnpicklingError):
+        return torch.load(model_path, map_location=map_location)
+
+
+def load_trained_model(model_path='models/kits23_trained_model.pth', map_location='cpu'):
+    """加载训练好的模型 (eval 模式)，参数直接使用内存映射的张量"""
+    checkpoint = load_checkpoint(model_path, map_location)
+    model = KITS23UNetFixed()
+    try:
+        model.load_state_dict(checkpoint['model_state_dict'], assign=True)
+    except TypeError:  # torch < 2.1 没有 assign 参数
+        model.load_state_dict(checkpoint['model_state_dict'])
+    return model.eval()
+
+
+def benchmark_forward_overhead(input_shape=(1, 1, 8, 16, 16), n_calls=300, repeats=5):
+    """小输入下每次 forward 的耗时，对比调试日志关闭 / 开启（输出到 NullHandler）
+
+    Returns:
+        dict: {'disabled': 秒/次, 'enabled': 秒/次}
+    """
+    torch.manual_seed(0)
+    model = KITS23UNetFixed().eval()
+    x = torch.rand(input_shape)
+    previous_level, previous_propagate = logger.level, logger.propagate
+    null_handler = logging.NullHandler()
+    timings = {}
+    try:
+        with torch.no_grad():
+            for name, level in (('disabled', logging.WARNING), ('enabled', logging.DEBUG)):
+                logger.setLevel(level)
+                if level == logging.DEBUG:
+                    logger.addHandler(null_handler)
+                    logger.propagate = False
+                for _ in range(10):
+                    model(x)
+                best = float('inf')
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    for _ in range(n_calls):
+                        model(x)
+                    best = min(best, (time.perf_counter() - start) / n_calls)
+                timings[name] = best
+    finally:
+        logger.removeHandler(null_handler)
+        logger.setLevel(previous_level)
+        logger.propagate = previous_propagate
+
+    print(f"⏱️  forward {tuple(input_shape)}: 日志关闭 {timings['disabled'] * 1e6:.0f} µs, "
+          f"开启 {timings['enabled'] * 1e6:.0f} µs")
+    return timings
+
+
 def test_fixed_model():
     print("🔍 测试修复的模型...")
     
@@ -87,4 +158,5 @@ def test_fixed_model():
     return model
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
     test_fixed_model()
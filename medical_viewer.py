@@ -1,39 +1,108 @@
-import torch
-import torch.nn.functional as F
-import matplotlib.pyplot as plt
+import os
+import logging
+
 import numpy as np
 
-from create_dataloader import KITS23Dataset
-from kits23_unet_fixed import KITS23UNetFixed
+from case_catalog import CaseCatalog, effective_spacing, ordered_case_names
+
+# torch、模型和各推理模块在首次使用时才导入，构建查看器本身不加载它们
+logger = logging.getLogger(__name__)
 
 
 class MedicalViewer:
-    def __init__(self):
-        self.dataset = KITS23Dataset()
+    def __init__(self, data_dir="preprocessed_data"):
+        self.data_dir = data_dir
+        self._dataset = None  # 首次加载病例时构建
+        self._case_names = None
         self.current_case_idx = 0
         self.current_slice = 64  # 中间切片
         self.window_center = 40   # CT窗位
         self.window_width = 400   # CT窗宽
-        self.model = None
-        self.model_loaded = False
+        self.model_path = None
+        self.model_loaded = False  # 检查点已注册；权重在首次推理时读取
+        self._model = None
+        self._predictor = None
+        self._memory_planner = None  # 按内存预算选择推理分块深度 / TTA 批大小
 
         self.ai_mask = None  # 存储AI预测结果
         self.has_ai_prediction = False  # 标记是否已预测
+        self.uncertainty = None  # 低分辨率不确定性图和OOD分数
 
         self.current_case_loaded = False  # 标记当前病例是否加载
         self.image = None
         self.mask = None
-
-    def load_case(self, case_idx):
-        """加载指定病例"""
+        self.image_factor = 1  # 当前加载的金字塔层级 (1 = 完整分辨率)
+        self.ai_prediction_factor = None  # AI预测使用的输入层级
+
+    @property
+    def dataset(self):
+        if self._dataset is None:
+            from create_dataloader import KITS23Dataset
+            self._dataset = KITS23Dataset(self.data_dir)
+        return self._dataset
+
+    @property
+    def case_names(self):
+        """病例顺序与 KITS23Dataset 一致，数据集尚未构建时只读取目录"""
+        if self._dataset is not None:
+            return self._dataset.case_names
+        if self._case_names is None:
+            self._case_names = ordered_case_names(self.data_dir)
+        return self._case_names
+
+    @property
+    def model(self):
+        if self._model is None and self.model_path is not None:
+            from kits23_unet_fixed import load_trained_model
+            print("🧠 加载AI分割模型...")
+            self._model = load_trained_model(self.model_path)
+        return self._model
+
+    @property
+    def memory_planner(self):
+        if self._memory_planner is None and self.model_loaded:
+            from memory_planner import MemoryPlanner
+            self._memory_planner = MemoryPlanner(self.model)
+        return self._memory_planner
+
+    @property
+    def predictor(self):
+        if self._predictor is None and self.model_loaded:
+            from streaming_inference import StreamingPredictor
+            self._predictor = StreamingPredictor(self.model, planner=self.memory_planner)
+        return self._predictor
+
+    @predictor.setter
+    def predictor(self, predictor):
+        self._predictor = predictor
+
+    def load_case(self, case_idx, factor=1):
+        """加载指定病例
+
+        Args:
+            factor: 面内下采样层级 (1/2/4)，>1 时从金字塔加载低分辨率副本
+        """
         try:
+            from resolution_pyramid import available_factors, load_level
+
             self.current_case_idx = case_idx
-            self.image, self.mask = self.dataset[case_idx]
+            case_name = self.case_names[case_idx]
+            if factor > 1 and factor in available_factors(case_name, self.data_dir):
+                self.image, self.mask = load_level(case_name, factor, self.data_dir)
+            else:
+                if factor > 1:
+                    print(f"⚠️  没有 x{factor} 金字塔层级，加载完整分辨率")
+                factor = 1
+                self.image, self.mask = self.dataset[case_idx]
             self.image = self.image.squeeze().numpy()  # [128,512,512]
             self.mask = self.mask.squeeze().numpy()  # [128,512,512]
+            self.image_factor = factor
             self.current_case_loaded = True
             self.ai_mask = None  # 重置AI预测
-            print(f"✅ 成功加载病例 {case_idx}")
+            self.has_ai_prediction = False
+            self.ai_prediction_factor = None
+            self.uncertainty = None
+            print(f"✅ 成功加载病例 {case_idx}" + (f" (x{factor} 概览)" if factor > 1 else ""))
             return self.get_case_info()
         except Exception as e:
             print(f"❌ 加载病例失败: {e}")
@@ -66,41 +135,136 @@ class MedicalViewer:
 
         return ct_slice, mask_slice
 
-    def get_case_info(self):
-        """获取病例信息"""
-        if not self.current_case_loaded:
+    def _catalog_record(self, case_name):
+        """病例目录中的记录，没有目录或未索引时返回 None"""
+        catalog_path = f"{self.data_dir}/catalog.sqlite"
+        if not os.path.exists(catalog_path):
+            return None
+        catalog = CaseCatalog(catalog_path)
+        record = catalog.get(case_name)
+        catalog.close()
+        return record
+
+    def get_case_info(self, case_idx=None):
+        """获取病例信息
+
+        Args:
+            case_idx: 给出时直接查询病例目录，不加载体积；默认为当前已加载的病例
+        Returns:
+            dict: name, shape, slices, factor（未加载时为 None）, catalog（目录记录或 None）
+        """
+        if case_idx is None:
+            if not self.current_case_loaded:
+                return {'name': 'No case loaded', 'shape': None, 'slices': 0}
+            case_name = self.case_names[self.current_case_idx]
+            shape = self.image.shape
+            return {
+                'name': case_name,
+                'shape': shape,
+                'slices': shape[0],
+                'factor': self.image_factor,
+                'catalog': self._catalog_record(case_name)
+            }
+
+        if not 0 <= case_idx < len(self.case_names):
             return {'name': 'No case loaded', 'shape': None, 'slices': 0}
-
-        case_name = f"case_{self.current_case_idx:05d}"
-        shape = self.image.shape
+        case_name = self.case_names[case_idx]
+        record = self._catalog_record(case_name)
+        shape = (record['depth'], record['height'], record['width']) if record else None
         return {
             'name': case_name,
             'shape': shape,
-            'slices': shape[0]
+            'slices': shape[0] if shape else 0,
+            'factor': None,
+            'catalog': record
         }
 
-    def load_model(self, model_path='models/kits23_trained_model.pth'):
-        """加载训练好的模型"""
-        print("🧠 加载AI分割模型...")
-        try:
-            self.model = KITS23UNetFixed()
-            checkpoint = torch.load(model_path, map_location='cpu')
-            self.model.load_state_dict(checkpoint['model_state_dict'])
-            self.model.eval()
-            self.model_loaded = True
-            print("✅ 模型加载成功!")
-            return True
-        except FileNotFoundError:
+    def get_case_spacing(self):
+        """当前病例（按当前金字塔层级）的体素间距 (D, H, W) mm，目录中没有原始信息时返回 None"""
+        if not self.current_case_loaded:
+            return None
+        spacing = effective_spacing(self._catalog_record(self.case_names[self.current_case_idx]))
+        if spacing is None:
+            return None
+        return (spacing[0], spacing[1] * self.image_factor, spacing[2] * self.image_factor)
+
+    def load_model(self, model_path='models/kits23_trained_model.pth', lazy=True):
+        """注册训练好的模型
+
+        Args:
+            lazy: True 时只检查文件，首次推理时才构建模型并通过内存映射读取权重
+        """
+        if not os.path.exists(model_path):
             print(f"❌ 模型文件不存在: {model_path}")
             # 列出models文件夹内容帮助调试
-            import os
             if os.path.exists('models'):
                 print(f"📁 models文件夹内容: {os.listdir('models')}")
             return False
+
+        self.model_path = model_path
+        self._model = None
+        self._predictor = None
+        self._memory_planner = None
+        self.model_loaded = True
+        if lazy:
+            print("✅ 模型已就绪 (首次推理时加载权重)")
+            return True
+
+        try:
+            self.model
+            print("✅ 模型加载成功!")
+            return True
         except Exception as e:
             print(f"❌ 模型加载失败: {e}")
+            self.model_path = None
+            self.model_loaded = False
+            return False
+
+    def set_tta(self, n_views=4, memory_budget_gb=None):
+        """启用测试时增强 (n_views<=1 时关闭)，会清除当前的AI预测
+
+        Args:
+            memory_budget_gb: 固定的批量前向内存预算，None 时由内存规划器决定每批视图数
+        """
+        if not self.model_loaded:
+            print("⚠️  请先加载模型")
+            return False
+
+        from streaming_inference import StreamingPredictor
+        from tta_inference import TTAPredictor, make_views
+
+        if n_views <= 1:
+            self.predictor = StreamingPredictor(self.model, planner=self.memory_planner)
+            print("ℹ️  已关闭TTA")
+        elif memory_budget_gb is None:
+            self.predictor = TTAPredictor(self.model, make_views(n_views), planner=self.memory_planner)
+            budget = self.memory_planner.budget_bytes / 1024 ** 3
+            print(f"🔁 已启用TTA: {n_views} 个视图, 内存预算 {budget:.1f} GB (自动)")
+        else:
+            self.predictor = TTAPredictor(self.model, make_views(n_views), memory_budget_gb)
+            print(f"🔁 已启用TTA: {n_views} 个视图, 内存预算 {memory_budget_gb} GB")
+        self.clear_ai_prediction()
+        return True
+
+    def set_cascade(self, enabled=True, coarse_shape=(64, 128, 128)):
+        """启用粗到细ROI级联推理（只在肾脏包围盒内做全分辨率推理），会清除当前的AI预测"""
+        if not self.model_loaded:
+            print("⚠️  请先加载模型")
             return False
 
+        from streaming_inference import StreamingPredictor
+        from roi_cascade import CascadePredictor
+
+        if enabled:
+            self.predictor = CascadePredictor(self.model, coarse_shape=coarse_shape,
+                                              planner=self.memory_planner)
+            print(f"🎯 已启用ROI级联推理: 粗定位尺寸 {coarse_shape}")
+        else:
+            self.predictor = StreamingPredictor(self.model, planner=self.memory_planner)
+            print("ℹ️  已关闭ROI级联推理")
+        self.clear_ai_prediction()
+        return True
+
     def predict_case(self, image_tensor):
         """对病例进行AI预测 - 修复版本"""
         if not self.model_loaded:
@@ -112,31 +276,26 @@ class MedicalViewer:
             return None
 
         try:
-            print(f"🔍 调试信息:")
-            print(f"   📊 输入数据范围: [{image_tensor.min():.3f}, {image_tensor.max():.3f}]")
-
-            with torch.no_grad():
-                image_tensor = image_tensor.float()
-                output = self.model(image_tensor.unsqueeze(0))
-
-                print(f"   📊 模型输出范围: [{output.min():.3f}, {output.max():.3f}]")
-                print(f"   📊 模型输出形状: {output.shape}")
-
-                # 修复：使用softmax将logits转换为概率
-                probabilities = F.softmax(output, dim=1)
-                print(f"   📊 Softmax后范围: [{probabilities.min():.3f}, {probabilities.max():.3f}]")
-                prediction = torch.argmax(probabilities, dim=1).squeeze(0)
-                print(f"   📊 原始预测类别: {torch.unique(prediction)}")
-
-                # 将类别3映射为背景
-                prediction = torch.where(prediction == 3, torch.tensor(0), prediction)
-
-                # 统计预测结果
-                unique, counts = torch.unique(prediction, return_counts=True)
-                class_distribution = dict(zip(unique.numpy(), counts.numpy()))
-                print(f"   📊 预测类别分布: {class_distribution}")
-
-                return prediction.numpy()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("🔍 输入数据范围: [%.3f, %.3f]", image_tensor.min(), image_tensor.max())
+
+            # 分块融合 argmax 与不确定性，不生成完整的 softmax 概率体积
+            result = self.predictor.predict(image_tensor)
+            prediction = result['prediction'].numpy()  # uint8, 类别3已映射为背景
+
+            scores = result['scores']
+            if logger.isEnabledFor(logging.DEBUG):
+                counts = np.bincount(prediction.ravel())
+                logger.debug("📊 预测类别分布: %s", {c: int(n) for c, n in enumerate(counts) if n})
+                logger.debug("📊 OOD分数: 熵=%.4f, 能量=%.4f, 低置信度比例=%.4f", scores['mean_entropy'],
+                             scores['mean_energy'], scores['low_confidence_fraction'])
+                if 'n_rois' in scores:
+                    logger.debug("📊 ROI: %d 个, 覆盖 %.1f%% 体素", scores['n_rois'], 100 * scores['roi_fraction'])
+                if 'mean_variance' in scores:
+                    logger.debug("📊 TTA方差: %.6f (%d 个视图)", scores['mean_variance'], scores['n_views'])
+
+            self.uncertainty = {'maps': result['maps'], 'scores': scores}
+            return prediction
 
         except Exception as e:
             print(f"❌ AI预测失败: {e}")
@@ -147,8 +306,14 @@ class MedicalViewer:
         if not self.model_loaded or not self.current_case_loaded:
             return False
 
-        if self.has_ai_prediction and self.ai_mask is not None:
-            return True  # 已经预测过了
+        if self.has_ai_prediction and self.ai_mask is not None and self.ai_prediction_factor == 1:
+            return True  # 已经完整预测过了（预览结果不算）
+
+        import torch
+
+        if self.image_factor > 1:
+            # 完整预测需要完整分辨率的影像
+            self.load_case(self.current_case_idx)
 
         print("🤖 运行AI分割...")
         image_tensor = torch.from_numpy(self.image).unsqueeze(0).float()
@@ -156,14 +321,20 @@ class MedicalViewer:
 
         if self.ai_mask is not None:
             self.has_ai_prediction = True
+            self.ai_prediction_factor = 1
             print("✅ AI预测完成")
             return True
         else:
             print("❌ AI预测失败")
             return False
 
-    def run_ai_prediction(self):
-        """显式运行AI预测 - 用户明确知道这是在执行耗时操作"""
+    def run_ai_prediction(self, preview=False, preview_factor=4):
+        """显式运行AI预测 - 用户明确知道这是在执行耗时操作
+
+        Args:
+            preview: 快速预览模式，在 x{preview_factor} 金字塔层级上推理后放大到当前分辨率，
+                     用于分诊；已有同样或更精细层级（完整预测或更小倍数的预览）的结果时直接复用
+        """
         if not self.model_loaded:
             print("⚠️  请先加载模型")
             return False
@@ -172,17 +343,33 @@ class MedicalViewer:
             print("⚠️  请先加载病例")
             return False
 
-        if self.has_ai_prediction:
+        requested_factor = preview_factor if preview else 1
+        if self.has_ai_prediction and self.ai_prediction_factor is not None \
+                and self.ai_prediction_factor <= requested_factor:
             print("ℹ️  已经运行过AI预测")
             return True
 
-        print("🤖 运行AI分割...")
+        if not preview and self.image_factor > 1:
+            # 完整预测需要完整分辨率的影像
+            self.load_case(self.current_case_idx)
+
+        print("🤖 运行AI分割..." + (f" (预览 x{preview_factor})" if preview else ""))
         try:
-            image_tensor = torch.from_numpy(self.image).unsqueeze(0).float()
+            import torch
+
+            if preview:
+                image_tensor = self._preview_input(preview_factor)
+                factor = preview_factor
+            else:
+                image_tensor = torch.from_numpy(self.image).unsqueeze(0).float()
+                factor = 1
             self.ai_mask = self.predict_case(image_tensor)
 
             if self.ai_mask is not None:
+                if self.ai_mask.shape != self.image.shape:
+                    self.ai_mask = self._resize_mask(self.ai_mask, self.image.shape)
                 self.has_ai_prediction = True
+                self.ai_prediction_factor = factor
                 print("✅ AI预测完成")
                 return True
             else:
@@ -192,6 +379,24 @@ class MedicalViewer:
             print(f"❌ AI预测异常: {e}")
             return False
 
+    def _preview_input(self, factor):
+        """预览推理的输入：优先读取金字塔层级，否则由当前影像下采样"""
+        import torch
+        from resolution_pyramid import available_factors, downsample_image, load_level
+
+        case_name = self.case_names[self.current_case_idx]
+        if factor in available_factors(case_name, self.data_dir):
+            image_tensor, _ = load_level(case_name, factor, self.data_dir)
+            return image_tensor
+        image_tensor = torch.from_numpy(self.image).unsqueeze(0).float()
+        return downsample_image(image_tensor, max(1, factor // self.image_factor))
+
+    @staticmethod
+    def _resize_mask(mask, shape):
+        """最近邻缩放预测掩码到目标形状"""
+        index = [np.arange(size) * src // size for size, src in zip(shape, mask.shape)]
+        return mask[np.ix_(*index)]
+
     def get_ai_prediction(self, slice_idx=None):
         """只获取AI预测的切片，绝对不触发预测"""
         if slice_idx is None:
@@ -207,7 +412,31 @@ class MedicalViewer:
             print(f"⚠️  切片索引超出范围: {slice_idx}")
             return None
 
+    def get_ood_scores(self):
+        """获取当前病例的OOD分数（需要先运行AI预测）"""
+        if self.uncertainty is None:
+            return None
+        return self.uncertainty['scores']
+
+    def get_uncertainty_map(self, kind='entropy', slice_idx=None):
+        """获取低分辨率不确定性图中对应的切片 (float16)
+
+        Args:
+            kind: 'max_softmax' / 'entropy' / 'energy'（TTA 模式下另有 'variance'）
+        """
+        if self.uncertainty is None:
+            return None
+        if slice_idx is None:
+            slice_idx = self.current_slice
+
+        uncertainty_map = self.uncertainty['maps'][kind]
+        scale = self.predictor.map_scale
+        return uncertainty_map[min(slice_idx // scale, uncertainty_map.shape[0] - 1)].numpy()
+
     def clear_ai_prediction(self):
         """清除当前的AI预测"""
         self.ai_mask = None
+        self.has_ai_prediction = False
+        self.ai_prediction_factor = None
+        self.uncertainty = None
         print("🧹 已清除AI预测结果")
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+"""
+KITS23UNetFixed 内存规划器
+1. 在 meta 设备上跟踪每个算子（含 interpolate / cat 和反向传播）的输出张量，
+   按张量的真实生命周期估计峰值内存（不实际分配）
+2. 在独立子进程中测量几个尺寸的实际峰值，拟合 固定开销 + 斜率 × 估计值
+3. 在内存预算内选择最大的 batch size / patch 尺寸，以及计算量最小的三维推理分块
+
+校准只在第一次需要时运行一次，结果缓存在 models/memory_calibration.json；
+也可以提前显式运行: python memory_planner.py --calibrate
+"""
+import os
+import sys
+import copy
+import json
+import weakref
+import subprocess
+
+import torch
+import torch.nn as nn
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+from streaming_inference import SIZE_MULTIPLE, receptive_halo, tile_ranges
+
+# 校准尺寸 (D, H, W)，从小到大；超出预算一半的尺寸会被跳过
+# CPU 上实测每体素开销随尺寸增大（卷积工作区、分配器碎片），所以取最陡的一段斜率
+CALIBRATION_SHAPES = {
+    'infer': ((32, 128, 128), (64, 256, 256), (128, 256, 256)),
+    'train': ((32, 128, 128), (32, 256, 256), (64, 256, 256)),
+}
+
+
+def default_budget_gb(device='cpu'):
+    """环境变量 KITS23_MEMORY_BUDGET_GB；否则 CPU 取物理内存的 60%，CUDA 取当前空闲显存的 90%"""
+    if os.environ.get('KITS23_MEMORY_BUDGET_GB'):
+        return float(os.environ['KITS23_MEMORY_BUDGET_GB'])
+    if torch.device(device).type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return 0.9 * free / 1024 ** 3
+    try:
+        total = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        total = 8 * 1024 ** 3
+    return 0.6 * total / 1024 ** 3
+
+
+class _LivenessTracker(TorchDispatchMode):
+    """记录每个算子新分配的张量，张量被释放时通过 weakref 回调扣除，得到同时存活的峰值
+
+    跳跃连接 (x, e1, e2) 一直被 Python 引用，autograd 保存的张量被计算图引用，
+    都会自然地保持存活；in-place 算子返回同一个张量、视图共享基张量，都不重复计数
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.live = 0
+        self.peak = 0
+        self.tracked = set()
+
+    def _track(self, t):
+        if not isinstance(t, torch.Tensor) or t._base is not None or id(t) in self.tracked:
+            return
+        key, size = id(t), t.numel() * t.element_size()
+        self.tracked.add(key)
+        self.live += size
+        self.peak = max(self.peak, self.live)
+        weakref.finalize(t, self._release, key, size)
+
+    def _release(self, key, size):
+        self.live -= size
+        self.tracked.discard(key)
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for t in tree_flatten(out)[0]:
+            self._track(t)
+        return out
+
+
+def estimate_activation_bytes(model, input_shape, batch_size=1, mode='infer', dtype=torch.float32):
+    """在 meta 设备上运行一次前向（train 时含反向），返回参数之外的峰值内存
+
+    infer: 输入 + 所有中间张量 + 输出
+    train: 另含 autograd 保存的激活、损失和参数梯度
+    """
+    if mode not in ('infer', 'train'):
+        raise ValueError(f"mode 必须是 'infer' 或 'train': {mode}")
+    meta_model = copy.deepcopy(model).to(device='meta', dtype=dtype)
+    meta_model.train(mode == 'train')
+    x = torch.empty((batch_size, 1) + tuple(input_shape), device='meta', dtype=dtype)
+    tracker = _LivenessTracker()
+    with tracker:
+        if mode == 'train':
+            target = torch.empty((batch_size,) + tuple(input_shape), device='meta', dtype=torch.long)
+            nn.CrossEntropyLoss()(meta_model(x), target).backward()
+        else:
+            with torch.no_grad():
+                output = meta_model(x)
+            del output
+    return tracker.peak + x.numel() * x.element_size()
+
+
+def _param_bytes(model, dtype=torch.float32):
+    element = torch.empty((), dtype=dtype).element_size()
+    return sum(p.numel() for p in model.parameters()) * element
+
+
+def _reset_peak_rss():
+    """Linux 上清除 VmHWM，之后的峰值只反映新的分配（其他平台无操作）"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024  # Linux 单位为 KB
+
+
+def _current_rss_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return _peak_rss_bytes()
+
+
+def _calibration_worker(mode, input_shape, batch_size=1, dtype_name='float32', device='cpu'):
+    """测量一次前向（训练时含反向和优化器）在参数/优化器状态之外的峰值内存增量
+
+    CPU 使用进程 RSS，CUDA 使用 max_memory_allocated。由 MemoryPlanner._measure
+    在独立的解释器中调用，避免污染调用方进程的内存峰值
+    """
+    from kits23_unet_fixed import KITS23UNetFixed
+
+    dtype = getattr(torch, dtype_name)
+    device = torch.device(device)
+    torch.manual_seed(0)
+    model = KITS23UNetFixed().to(device=device, dtype=dtype)
+    x = torch.rand((batch_size, 1) + tuple(input_shape), device=device, dtype=dtype)
+    target = torch.randint(0, 4, (batch_size,) + tuple(input_shape), device=device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    model.train(mode == 'train')
+
+    def step():
+        if mode == 'train':
+            loss = nn.CrossEntropyLoss()(model(x), target)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        else:
+            with torch.no_grad():
+                model(x)
+
+    # 预热一次（优化器状态、算子初始化），再从当前占用开始测量
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+        step()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - baseline
+    _reset_peak_rss()
+    baseline = _current_rss_bytes()
+    step()
+    return _peak_rss_bytes() - baseline
+
+
+_MEASURE_CODE = """
+import sys
+from memory_planner import _calibration_worker
+print(_calibration_worker({mode!r}, {shape!r}, 1, {dtype!r}, {device!r}))
+"""
+
+
+class MemoryPlanner:
+    """为 KITS23UNetFixed 选择适合内存预算的 batch / patch / 分块尺寸
+
+    Args:
+        model: KITS23UNetFixed 实例（只用于跟踪算子，不会被修改）
+        budget_gb: 内存预算，默认见 default_budget_gb
+        dtype: 计算精度 (torch.float32 / torch.bfloat16 / torch.float16)
+        device: 规划的目标设备，'cuda' 时按显存预算和 CUDA 分配器校准
+        calibrate: 是否运行校准（结果缓存在 cache_path）
+    """
+
+    def __init__(self, model=None, budget_gb=None, dtype=torch.float32, device='cpu', calibrate=True,
+                 cache_path="models/memory_calibration.json"):
+        if model is None:
+            from kits23_unet_fixed import KITS23UNetFixed
+            model = KITS23UNetFixed()
+        self.model = model
+        self.device = torch.device(device)
+        self.budget_bytes = (budget_gb or default_budget_gb(self.device)) * 1024 ** 3
+        self.dtype = dtype
+        self.calibrate_enabled = calibrate
+        self.cache_path = cache_path
+        self._calibrations = {}
+        self._estimates = {}
+
+    def _load_cache(self):
+        if self.cache_path and os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                return json.load(f)
+        return {}
+
+    def _cache_key(self, mode):
+        dtype_name = str(self.dtype).replace('torch.', '')
+        return f"{mode}:{torch.__version__}:{self.device.type}:{dtype_name}:{CALIBRATION_SHAPES[mode]}"
+
+    def calibration(self, mode='infer'):
+        """实测峰值 ≈ offset + slope × 算子跟踪估计
+
+        在 CALIBRATION_SHAPES 的每个尺寸上各测量一次：slope 取相邻尺寸间最陡的一段，
+        offset 取使拟合不低于任何实测点的最小值，外推到更大尺寸时偏保守
+
+        Returns:
+            (offset_bytes, slope)
+        """
+        if not self.calibrate_enabled:
+            return 0.0, 1.0
+        if mode in self._calibrations:
+            return self._calibrations[mode]
+
+        key = self._cache_key(mode)
+        cache = self._load_cache()
+        if key not in cache:
+            points = []
+            for shape in CALIBRATION_SHAPES[mode]:
+                estimated = estimate_activation_bytes(self.model, shape, 1, mode, self.dtype)
+                if points and estimated * 2 > self.budget_bytes:
+                    break  # 测量本身不能超出预算
+                print(f"📏 校准内存模型 ({mode}, {self.device.type}, 输入 {shape})...")
+                measured = self._measure(mode, shape)
+                if measured is None:
+                    break
+                points.append((estimated, measured))
+                print(f"   实测 {measured / 1024 ** 2:.0f} MB, 估计 {estimated / 1024 ** 2:.0f} MB")
+
+            if len(points) < 2:
+                print("⚠️  校准失败，使用未修正的算子跟踪估计")
+                self._calibrations[mode] = (0.0, 1.0)
+                return self._calibrations[mode]
+
+            slope = max((m2 - m1) / (e2 - e1) for (e1, m1), (e2, m2) in zip(points, points[1:]))
+            slope = min(4.0, max(0.5, slope))
+            offset = max(0.0, max(m - slope * e for e, m in points))
+            cache[key] = {'offset': offset, 'slope': slope}
+            print(f"   拟合: 固定开销 {offset / 1024 ** 2:.0f} MB, 斜率 {slope:.2f}")
+            if self.cache_path:
+                os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+                with open(self.cache_path, 'w') as f:
+                    json.dump(cache, f, indent=2)
+
+        self._calibrations[mode] = (cache[key]['offset'], cache[key]['slope'])
+        return self._calibrations[mode]
+
+    def _measure(self, mode, shape, timeout=600):
+        """在全新的解释器中测量（不经过 multiprocessing，不会重新执行调用方的脚本），失败时返回 None"""
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                          env.get('PYTHONPATH')]))
+        code = _MEASURE_CODE.format(mode=mode, shape=tuple(shape),
+                                    dtype=str(self.dtype).replace('torch.', ''), device=str(self.device))
+        try:
+            proc = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True,
+                                  text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            print(f"❌ 校准超时 ({timeout}s)")
+            return None
+        if proc.returncode != 0:
+            lines = proc.stderr.strip().splitlines()
+            print(f"❌ 校准进程失败: {lines[-1] if lines else proc.returncode}")
+            return None
+        return int(proc.stdout.strip().splitlines()[-1])
+
+    def peak_bytes(self, input_shape, batch_size=1, mode='infer'):
+        """校准后的峰值内存估计
+
+        参数常驻；训练时另有 Adam 的两个动量（梯度已包含在算子跟踪中）
+        """
+        params = _param_bytes(self.model, self.dtype) * (3 if mode == 'train' else 1)
+        offset, slope = self.calibration(mode)
+        key = (tuple(input_shape), batch_size, mode)
+        if key not in self._estimates:
+            self._estimates[key] = estimate_activation_bytes(self.model, input_shape, batch_size, mode, self.dtype)
+        activations = self._estimates[key]
+        return params + offset + slope * activations
+
+    def fits(self, input_shape, batch_size=1, mode='infer', reserved_bytes=0):
+        return self.peak_bytes(input_shape, batch_size, mode) + reserved_bytes <= self.budget_bytes
+
+    def plan_inference(self, volume_shape, halo=None, step=16, reserved_bytes=0):
+        """选择预算内前向计算量最小的三维分块
+
+        深度分块取 step 的倍数，面内分块取 H、W 的 1/2、1/4 ...（8 的倍数，不小于 32）；
+        每块在每个方向两侧各多推理 halo 个体素，所以分块越小重复计算越多。
+        候选按总输入体素数从小到大检查，第一个放得下的就是计算量最小的方案
+
+        Args:
+            halo: (D, H, W) 或 int，None 时取模型的感受野半径（receptive_halo）
+            reserved_bytes: 推理期间另外常驻的内存（例如 TTA 的均值/方差体积）
+        Returns:
+            dict: tile_shape ((D, H, W)，None 表示整体推理), halo,
+                  peak_gb, compute (总输入体素数 / 体积体素数)
+        Raises:
+            MemoryError: 最小的分块也超出预算
+        """
+        depth, height, width = volume_shape
+        if halo is None:
+            halo = receptive_halo(self.model)
+        halo = tuple(halo) if isinstance(halo, (tuple, list)) else (halo,) * 3
+
+        def plane_tiles(size):
+            tiles = [size]
+            while tiles[-1] // 2 // SIZE_MULTIPLE * SIZE_MULTIPLE >= 32:
+                tiles.append(tiles[-1] // 2 // SIZE_MULTIPLE * SIZE_MULTIPLE)
+            return tiles
+
+        axis_tiles = ([depth] + list(range((depth - 1) // step * step, 0, -step)),
+                      plane_tiles(height), plane_tiles(width))
+        # 每个方向: 分块大小 -> (所有分块输入长度之和, 最大输入长度)
+        axis_costs = []
+        for size, tiles, h in zip(volume_shape, axis_tiles, halo):
+            costs = {}
+            for tile in tiles:
+                lengths = [hi - lo for _, _, lo, hi in tile_ranges(size, tile, h)]
+                costs[tile] = (sum(lengths), max(lengths))
+            axis_costs.append(costs)
+
+        candidates = []
+        for td, (d_sum, d_max) in axis_costs[0].items():
+            for th, (h_sum, h_max) in axis_costs[1].items():
+                for tw, (w_sum, w_max) in axis_costs[2].items():
+                    candidates.append((d_sum * h_sum * w_sum, (td, th, tw), (d_max, h_max, w_max)))
+        candidates.sort()
+
+        voxels = depth * height * width
+        # 常驻输出：uint8 预测
+        reserved = voxels + reserved_bytes
+        for compute, tile, input_shape in candidates:
+            in_plane = tile[1] < height or tile[2] < width
+            # 面内分块时，一个深度分块的 logits 要先拼回整个平面: [C=4, tile_depth, H, W] float32
+            assembled = 4 * 4 * tile[0] * height * width if in_plane else 0
+            peak = self.peak_bytes(input_shape, 1, 'infer') + reserved + assembled
+            if peak <= self.budget_bytes:
+                return {'tile_shape': None if tuple(tile) == tuple(volume_shape) else tile,
+                        'halo': halo, 'peak_gb': peak / 1024 ** 3, 'compute': compute / voxels}
+
+        raise MemoryError(f"内存预算 {self.budget_bytes / 1024 ** 3:.1f} GB 不足以推理 {tuple(volume_shape)}: "
+                          f"最小分块 {tile} 也需要约 {peak / 1024 ** 3:.2f} GB")
+
+    def plan_training(self, volume_shape, max_batch_size=8):
+        """先尽量保持完整体积并增大 batch；batch=1 也放不下时依次减半深度和面内尺寸
+
+        Returns:
+            dict: batch_size, patch_size (D, H, W), peak_gb
+        """
+        patch = list(volume_shape)
+        while True:
+            batch_size = 0
+            for b in range(1, max_batch_size + 1):
+                if not self.fits(patch, b, 'train'):
+                    break
+                batch_size = b
+            if batch_size > 0:
+                peak = self.peak_bytes(patch, batch_size, 'train')
+                return {'batch_size': batch_size, 'patch_size': tuple(patch), 'peak_gb': peak / 1024 ** 3}
+
+            # 缩小最大的维度（保持 8 的倍数）
+            axis = max(range(3), key=lambda a: patch[a])
+            if patch[axis] // 2 < SIZE_MULTIPLE * 2:
+                print(f"⚠️  内存预算 {self.budget_bytes / 1024 ** 3:.1f} GB 不足以训练，使用最小 patch")
+                return {'batch_size': 1, 'patch_size': tuple(patch),
+                        'peak_gb': self.peak_bytes(patch, 1, 'train') / 1024 ** 3}
+            patch[axis] = patch[axis] // 2 // SIZE_MULTIPLE * SIZE_MULTIPLE
+
+    def max_batch(self, input_shape, limit, mode='infer', reserved_bytes=0):
+        """预算内一次前向能容纳的最大 batch（至少为 1，调用方用 fits 判断 1 是否放得下）"""
+        best = 1
+        for b in range(2, limit + 1):
+            if not self.fits(input_shape, b, mode, reserved_bytes):
+                break
+            best = b
+        return best
+
+    def report(self, volume_shape=(128, 512, 512)):
+        print(f"🧮 内存预算 ({self.device.type}): {self.budget_bytes / 1024 ** 3:.1f} GB")
+        for mode in ('infer', 'train'):
+            peak = self.peak_bytes(volume_shape, 1, mode)
+            print(f"  {mode} 1×{volume_shape}: 约 {peak / 1024 ** 3:.2f} GB")
+        print(f"  推理计划: {self.plan_inference(volume_shape)}")
+        print(f"  训练计划: {self.plan_training(volume_shape)}")
+
+
+if __name__ == "__main__":
+    planner = MemoryPlanner(device=sys.argv[sys.argv.index('--device') + 1] if '--device' in sys.argv else 'cpu')
+    if '--calibrate' in sys.argv:
+        # 显式校准：丢弃缓存中当前配置的结果后重新测量
+        cache = planner._load_cache()
+        for mode in ('infer', 'train'):
+            cache.pop(planner._cache_key(mode), None)
+        if os.path.exists(planner.cache_path):
+            with open(planner.cache_path, 'w') as f:
+                json.dump(cache, f, indent=2)
+        for mode in ('infer', 'train'):
+            planner.calibration(mode)
+    planner.report()
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+KITS23 OOD 鲁棒性基准 - 即时生成的分布偏移
+在 KITS23Dataset 输出上按需施加参数化腐蚀（不写入磁盘），
+并在 腐蚀类型×严重程度 网格上评估 KITS23UNetFixed
+"""
+import os
+import csv
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+
+from case_catalog import file_hash
+from create_dataloader import KITS23Dataset
+from evaluate_segmentation import LABELS, confusion_matrix, overlap_metrics
+from memory_planner import MemoryPlanner, default_budget_gb
+from streaming_inference import StreamingPredictor
+
+# CT 标准化窗口，与 KITS23Preprocessor 默认值一致
+CT_MIN, CT_MAX = -100, 400
+
+# 每种腐蚀 5 个严重程度的参数（强度在 [0,1] 标准化后的单位下）
+SEVERITY_PARAMS = {
+    'gaussian_noise': [0.02, 0.04, 0.06, 0.08, 0.12],           # 噪声标准差
+    'rician_noise': [0.02, 0.04, 0.06, 0.08, 0.12],             # 两个通道的噪声标准差
+    'gaussian_blur': [0.5, 1.0, 1.5, 2.0, 3.0],                 # 高斯核 sigma (体素)
+    'contrast_shift': [(0.9, 0.02), (0.8, 0.05), (0.7, 0.08),
+                       (0.6, 0.12), (0.5, 0.15)],               # (对比度增益, 亮度偏移)
+    'hu_window_mismatch': [(-150, 450), (-200, 500), (-300, 600),
+                           (-50, 250), (0, 200)],               # 错误的 HU 窗口
+    'slice_thickness': [1.5, 2.0, 3.0, 4.0, 6.0],               # 层厚放大倍数
+    'ghosting': [(0.05, 8), (0.1, 16), (0.15, 24),
+                 (0.25, 32), (0.35, 48)],                       # (鬼影强度, 位移像素)
+    'missing_slices': [0.05, 0.1, 0.2, 0.3, 0.4],               # 缺失切片比例
+}
+
+CORRUPTIONS = list(SEVERITY_PARAMS.keys())
+
+
+def _as_batch(images):
+    """统一为 [B, 1, D, H, W]"""
+    if images.dim() == 4:
+        return images.unsqueeze(0), True
+    return images, False
+
+
+def gaussian_noise(x, std, generator=None):
+    noise = torch.randn(x.shape, generator=generator, dtype=x.dtype) * std
+    return x + noise
+
+
+def rician_noise(x, std, generator=None):
+    """Rician 噪声：幅值 = sqrt((x + n1)^2 + n2^2)"""
+    n1 = torch.randn(x.shape, generator=generator, dtype=x.dtype) * std
+    n2 = torch.randn(x.shape, generator=generator, dtype=x.dtype) * std
+    return torch.sqrt((x + n1) ** 2 + n2 ** 2)
+
+
+def gaussian_blur(x, sigma, generator=None):
+    """可分离的三维高斯模糊，一次 conv3d 处理整个批次"""
+    radius = max(1, int(round(3 * sigma)))
+    coords = torch.arange(-radius, radius + 1, dtype=x.dtype)
+    kernel = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    kernel = kernel / kernel.sum()
+    for dim in range(3):
+        shape = [1, 1, 1, 1, 1]
+        shape[2 + dim] = len(kernel)
+        pad = [0] * 6
+        # F.pad 的顺序从最后一维开始: (W, W, H, H, D, D)
+        pad[2 * (2 - dim)] = pad[2 * (2 - dim) + 1] = radius
+        x = F.conv3d(F.pad(x, pad, mode='replicate'), kernel.view(shape))
+    return x
+
+
+def contrast_shift(x, params, generator=None):
+    gain, bias = params
+    return (x - 0.5) * gain + 0.5 + bias
+
+
+def hu_window_mismatch(x, window, generator=None):
+    """按训练窗口还原 HU，再用错误的窗口重新标准化"""
+    new_min, new_max = window
+    hu = x * (CT_MAX - CT_MIN) + CT_MIN
+    return (hu - new_min) / (new_max - new_min)
+
+
+def slice_thickness(x, factor, generator=None):
+    """模拟更厚的切片：沿深度平均下采样后线性插值回原尺寸"""
+    depth = x.shape[2]
+    thick_depth = max(1, int(round(depth / factor)))
+    thick = F.interpolate(x, size=(thick_depth,) + tuple(x.shape[3:]), mode='area')
+    return F.interpolate(thick, size=tuple(x.shape[2:]), mode='trilinear', align_corners=False)
+
+
+def ghosting(x, params, generator=None):
+    """运动伪影：沿相位编码方向 (H) 叠加衰减的位移副本"""
+    alpha, shift = params
+    ghost = 0.5 * (torch.roll(x, shift, dims=3) + torch.roll(x, -shift, dims=3))
+    return (1 - alpha) * x + alpha * ghost
+
+
+def missing_slices(x, fraction, generator=None):
+    """随机丢弃切片（置零），每个样本独立采样"""
+    keep = torch.rand((x.shape[0], 1, x.shape[2], 1, 1), generator=generator) >= fraction
+    return x * keep.to(x.dtype)
+
+
+CORRUPTION_FNS = {
+    'gaussian_noise': gaussian_noise,
+    'rician_noise': rician_noise,
+    'gaussian_blur': gaussian_blur,
+    'contrast_shift': contrast_shift,
+    'hu_window_mismatch': hu_window_mismatch,
+    'slice_thickness': slice_thickness,
+    'ghosting': ghosting,
+    'missing_slices': missing_slices,
+}
+
+
+def apply_corruption(images, corruption, severity, generator=None):
+    """对一个批次施加腐蚀
+
+    Args:
+        images: [B, 1, D, H, W] 或 [1, D, H, W]，强度在 [0, 1]
+        corruption: CORRUPTIONS 中的名称
+        severity: 1-5，0 表示不做处理
+    """
+    if severity == 0:
+        return images
+    if corruption not in CORRUPTION_FNS:
+        raise ValueError(f"未知腐蚀类型: {corruption}，可选: {CORRUPTIONS}")
+    if not 1 <= severity <= len(SEVERITY_PARAMS[corruption]):
+        raise ValueError(f"严重程度必须在 1-{len(SEVERITY_PARAMS[corruption])} 之间: {severity}")
+
+    x, squeezed = _as_batch(images.float())
+    params = SEVERITY_PARAMS[corruption][severity - 1]
+    with torch.no_grad():
+        x = CORRUPTION_FNS[corruption](x, params, generator=generator)
+        x = x.clamp_(0, 1)
+    return x.squeeze(0) if squeezed else x
+
+
+def corruption_seed(corruption, severity, case_idx, base_seed=0):
+    """(腐蚀, 严重程度, 病例) 的确定性随机种子，保证结果可复现"""
+    return zlib.crc32(f"{corruption}:{severity}:{case_idx}:{base_seed}".encode())
+
+
+class CorruptedDataset(Dataset):
+    """在 KITS23Dataset 之上惰性施加腐蚀，不生成磁盘副本"""
+
+    def __init__(self, base_dataset, corruption, severity, seed=0):
+        self.base = base_dataset
+        self.corruption = corruption
+        self.severity = severity
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.base)
+
+    def __getitem__(self, idx):
+        image, mask = self.base[idx]
+        generator = torch.Generator().manual_seed(
+            corruption_seed(self.corruption, self.severity, idx, self.seed))
+        return apply_corruption(image, self.corruption, self.severity, generator), mask
+
+
+# ---------------------------------------------------------------------------
+# 进程池工作进程：每个进程只加载一次模型和数据集
+# ---------------------------------------------------------------------------
+_WORKER = {}
+
+
+def _init_worker(model_path, data_dir, num_threads, budget_gb):
+    from kits23_unet_fixed import load_trained_model
+
+    torch.set_num_threads(num_threads)
+    # 内存映射加载：各工作进程共享同一份文件页
+    model = load_trained_model(model_path)
+    # 与 MedicalViewer.predict_case 相同的推理路径（类别3映射为背景），按本进程分到的预算分块
+    _WORKER['predictor'] = StreamingPredictor(model, planner=MemoryPlanner(model, budget_gb=budget_gb))
+    _WORKER['dataset'] = KITS23Dataset(data_dir)
+
+
+def _clean_job(case_idx, cache_path):
+    """预测干净病例并缓存结果"""
+    image, mask = _WORKER['dataset'][case_idx]
+    result = _WORKER['predictor'].predict(image)
+    # 与预测一起缓存 OOD 分数，缓存命中时干净基线的 mean_entropy / mean_energy 不会丢失
+    torch.save({'prediction': result['prediction'], 'scores': result['scores']}, cache_path)
+    return _scores(mask.squeeze(0).numpy(), result['prediction'].numpy(), result['scores'])
+
+
+def _corrupted_job(case_idx, corruption, severity, cache_path, seed):
+    image, mask = CorruptedDataset(_WORKER['dataset'], corruption, severity, seed)[case_idx]
+    result = _WORKER['predictor'].predict(image)
+    prediction = result['prediction'].numpy()
+    clean_prediction = torch.load(cache_path)['prediction'].numpy()
+    scores = _scores(mask.squeeze(0).numpy(), prediction, result['scores'])
+    # 与干净预测的一致性：不依赖标注的稳定性指标
+    consistency = overlap_metrics(confusion_matrix(clean_prediction, prediction))['dice']
+    scores['consistency'] = _nanmean(consistency[1:])
+    return scores
+
+
+def _nanmean(values):
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    return float(values.mean()) if len(values) else float('nan')
+
+
+def _scores(gt, prediction, ood_scores=None):
+    dice = overlap_metrics(confusion_matrix(gt, prediction))['dice']
+    scores = {f"dice_{LABELS[c]}": float(dice[c]) for c in range(1, len(LABELS))}
+    scores['dice_mean'] = _nanmean(dice[1:])
+    if ood_scores is not None:
+        scores['mean_entropy'] = ood_scores['mean_entropy']
+        scores['mean_energy'] = ood_scores['mean_energy']
+    return scores
+
+
+class RobustnessRunner:
+    """在 腐蚀×严重程度 网格上评估模型并输出退化曲线
+
+    memory_budget_gb 是所有工作进程合计的推理内存预算（默认见 default_budget_gb），
+    平均分给每个进程的 MemoryPlanner
+    """
+
+    def __init__(self, model_path='models/kits23_trained_model.pth', data_dir="preprocessed_data",
+                 corruptions=None, severities=(1, 2, 3, 4, 5), num_workers=2,
+                 cache_dir="robustness_cache", seed=0, memory_budget_gb=None):
+        self.model_path = model_path
+        self.data_dir = data_dir
+        self.corruptions = corruptions or CORRUPTIONS
+        self.severities = severities
+        self.num_workers = num_workers
+        self.cache_dir = cache_dir
+        self.seed = seed
+        self.memory_budget_gb = memory_budget_gb
+        self.model_key = None
+
+    def _model_key(self):
+        """检查点内容哈希：重新训练或换用其他检查点时不会复用旧的干净预测"""
+        if self.model_key is None:
+            self.model_key = file_hash(self.model_path)[:16]
+        return self.model_key
+
+    def _cache_path(self, case_name):
+        """干净预测缓存，按 检查点哈希 / 病例名 + 预处理文件的大小和修改时间 区分
+
+        v2: 文件内容为 {'prediction', 'scores'}（旧格式只有预测，不再命中）
+        """
+        stat = os.stat(os.path.join(self.data_dir, f"{case_name}.pt"))
+        return os.path.join(self.cache_dir, "clean", self._model_key(),
+                            f"{case_name}_{stat.st_size}_{stat.st_mtime_ns}_v2.pt")
+
+    def run(self, output_csv="evaluation/robustness.csv", max_cases=None):
+        """运行整个基准
+
+        Returns:
+            dict: {corruption: [(severity, mean_dice, mean_consistency), ...]}，severity=0 为干净数据
+        """
+        self.model_key = None  # 检查点可能在两次运行之间被替换
+        dataset = KITS23Dataset(self.data_dir)
+        case_names = list(dataset.case_names)
+        if max_cases is not None:
+            case_names = case_names[:max_cases]
+        os.makedirs(os.path.join(self.cache_dir, "clean", self._model_key()), exist_ok=True)
+        os.makedirs(os.path.dirname(output_csv) or '.', exist_ok=True)
+
+        threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+        budget_gb = (self.memory_budget_gb or default_budget_gb()) / self.num_workers
+        print(f"🚀 鲁棒性评估: {len(case_names)} 个病例 × {len(self.corruptions)} 种腐蚀 "
+              f"× {len(self.severities)} 个严重程度, {self.num_workers} 个进程 (每个 {budget_gb:.1f} GB)")
+        # 在启动工作进程前校准一次，避免多个进程同时校准
+        MemoryPlanner(budget_gb=budget_gb).calibration('infer')
+
+        rows = []
+        with ProcessPoolExecutor(max_workers=self.num_workers, initializer=_init_worker,
+                                 initargs=(self.model_path, self.data_dir, threads, budget_gb)) as pool:
+            # 1. 干净预测：已缓存的病例直接跳过推理
+            clean_futures = {}
+            for idx, name in enumerate(case_names):
+                if not os.path.exists(self._cache_path(name)):
+                    clean_futures[pool.submit(_clean_job, idx, self._cache_path(name))] = name
+            for fut in as_completed(clean_futures):
+                rows.append(self._row(clean_futures[fut], 'clean', 0, fut.result()))
+            cached = set(clean_futures.values())
+            for idx, name in enumerate(case_names):
+                if name not in cached:
+                    cached_result = torch.load(self._cache_path(name))
+                    mask = dataset[idx][1].squeeze(0).numpy()
+                    rows.append(self._row(name, 'clean', 0, _scores(
+                        mask, cached_result['prediction'].numpy(), cached_result['scores'])))
+            print(f"✅ 干净预测完成 (缓存: {self.cache_dir}/clean/{self._model_key()})")
+
+            # 2. 腐蚀网格
+            futures = {}
+            for corruption in self.corruptions:
+                for severity in self.severities:
+                    for idx, name in enumerate(case_names):
+                        fut = pool.submit(_corrupted_job, idx, corruption, severity,
+                                          self._cache_path(name), self.seed)
+                        futures[fut] = (name, corruption, severity)
+            for i, fut in enumerate(as_completed(futures), 1):
+                name, corruption, severity = futures[fut]
+                row = self._row(name, corruption, severity, fut.result())
+                rows.append(row)
+                print(f"[{i}/{len(futures)}] {name} {corruption}@{severity}: Dice={row['dice_mean']:.3f}")
+
+        self._write_csv(rows, output_csv)
+        curves = self.degradation_curves(rows)
+        self.print_curves(curves)
+        return curves
+
+    @staticmethod
+    def _row(case_name, corruption, severity, scores):
+        row = {'case': case_name, 'corruption': corruption, 'severity': severity}
+        row.update(scores)
+        return row
+
+    @staticmethod
+    def _write_csv(rows, output_csv):
+        fieldnames = list(dict.fromkeys(key for row in rows for key in row))
+        with open(output_csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"📁 结果保存在: {output_csv}")
+
+    def degradation_curves(self, rows):
+        """按 (腐蚀, 严重程度) 汇总平均 Dice 与一致性"""
+        clean = [r['dice_mean'] for r in rows if r['corruption'] == 'clean']
+        clean_dice = _nanmean(clean)
+        curves = {}
+        for corruption in self.corruptions:
+            points = [(0, clean_dice, 1.0)]
+            for severity in self.severities:
+                subset = [r for r in rows if r['corruption'] == corruption and r['severity'] == severity]
+                if subset:
+                    points.append((severity,
+                                   _nanmean([r['dice_mean'] for r in subset]),
+                                   _nanmean([r['consistency'] for r in subset])))
+            curves[corruption] = points
+        return curves
+
+    @staticmethod
+    def print_curves(curves):
+        print(f"\n{'='*50}")
+        print("📉 退化曲线 (平均 Dice / 与干净预测一致性):")
+        for corruption, points in curves.items():
+            text = "  ".join(f"s{s}: {d:.3f}/{c:.3f}" for s, d, c in points)
+            print(f"  {corruption:20s} {text}")
+
+    @staticmethod
+    def plot_curves(curves, output_path="evaluation/degradation_curves.png"):
+        import matplotlib.pyplot as plt
+
+        fig, axes = plt.subplots(1, 2, figsize=(14, 5))
+        for corruption, points in curves.items():
+            severities = [p[0] for p in points]
+            axes[0].plot(severities, [p[1] for p in points], marker='o', label=corruption)
+            axes[1].plot(severities, [p[2] for p in points], marker='o', label=corruption)
+        axes[0].set_title('Mean Dice vs Severity')
+        axes[1].set_title('Consistency with Clean Prediction')
+        for ax in axes:
+            ax.set_xlabel('Severity')
+            ax.grid(alpha=0.3)
+        axes[1].legend(fontsize=8)
+        plt.tight_layout()
+        plt.savefig(output_path, dpi=120)
+        plt.close(fig)
+        print(f"📈 曲线保存在: {output_path}")
+
+
+if __name__ == "__main__":
+    runner = RobustnessRunner()
+    curves = runner.run()
+    runner.plot_curves(curves)
@@ -7,9 +7,16 @@ import os
 import glob
 import torch
 from run_preprocessor_final import KITS23Preprocessor
+from case_catalog import CaseCatalog, build_record
+from resolution_pyramid import DEFAULT_FACTORS, save_pyramid, level_path
 
-def preprocess_all():
-    """处理所有病例并保存"""
+def preprocess_all(force=False, pyramid_factors=DEFAULT_FACTORS):
+    """处理所有病例并保存
+
+    Args:
+        force: 忽略病例目录，重新处理所有病例
+        pyramid_factors: 额外保存的面内下采样层级 (None 或空表示不生成金字塔)
+    """
     
     print("🔄 开始批量处理所有 KITS23 数据...")
     
@@ -18,7 +25,7 @@ def preprocess_all():
     
     # 查找所有病例
     dataset_path = "dataset"
-    cases = glob.glob(f"{dataset_path}/case_*/imaging.nii.gz", recursive=True)
+    cases = sorted(glob.glob(f"{dataset_path}/case_*/imaging.nii.gz", recursive=True))
     
     print(f"找到 {len(cases)} 个病例")
     
@@ -26,7 +33,11 @@ def preprocess_all():
     output_dir = "preprocessed_data"
     os.makedirs(output_dir, exist_ok=True)
     
+    # 病例目录：增量更新，源文件没有变化的病例直接跳过
+    catalog = CaseCatalog(f"{output_dir}/catalog.sqlite")
+    
     success_count = 0
+    skipped_count = 0
     error_cases = []
     
     for i, case_path in enumerate(cases):
@@ -36,9 +47,21 @@ def preprocess_all():
         print(f"\n[{i+1}/{len(cases)}] 处理 {case_name}...")
         
         if os.path.exists(seg_path):
+            output_path = f"{output_dir}/{case_name}.pt"
+            if not force and catalog.is_up_to_date(case_name, [case_path, seg_path], output_path):
+                missing = [f for f in pyramid_factors or ()
+                           if not os.path.exists(level_path(output_dir, case_name, f))]
+                if missing:
+                    data = torch.load(output_path)
+                    save_pyramid(case_name, data['image'], data['segmentation'], output_dir, missing)
+                success_count += 1
+                skipped_count += 1
+                print(f"⏭️  未变化，跳过: {case_name}")
+                continue
+            
             try:
                 # 预处理
-                image_tensor, seg_tensor = preprocessor.preprocess(case_path, seg_path)
+                image_tensor, seg_tensor, info = preprocessor.preprocess(case_path, seg_path, return_info=True)
                 
                 # 保存处理后的数据
                 torch.save({
@@ -46,10 +69,17 @@ def preprocess_all():
                     'segmentation': seg_tensor,
                     'case_name': case_name,
                     'original_shape': f"{image_tensor.shape}"
-                }, f"{output_dir}/{case_name}.pt")
+                }, output_path)
+                
+                catalog.upsert(build_record(case_name, output_path, seg_tensor, info,
+                                            source_paths=[case_path, seg_path]))
+                
+                # 多分辨率金字塔（概览和预览推理使用）
+                if pyramid_factors:
+                    save_pyramid(case_name, image_tensor, seg_tensor, output_dir, pyramid_factors)
                 
                 success_count += 1
-                print(f"✅ 已保存: {output_dir}/{case_name}.pt")
+                print(f"✅ 已保存: {output_path}")
                 
             except Exception as e:
                 error_msg = f"{case_name}: {e}"
@@ -63,9 +93,11 @@ def preprocess_all():
     # 输出总结
     print(f"\n{'='*50}")
     print(f"🎉 批量处理完成!")
-    print(f"✅ 成功: {success_count}/{len(cases)} 个病例")
+    print(f"✅ 成功: {success_count}/{len(cases)} 个病例 (其中 {skipped_count} 个未变化)")
     print(f"❌ 失败: {len(error_cases)} 个病例")
     print(f"📁 数据保存在: {output_dir}/")
+    print(f"📇 病例目录: {catalog.db_path} ({len(catalog)} 个病例)")
+    catalog.close()
     
     if error_cases:
         print(f"\n失败病例:")
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+多分辨率金字塔存储
+在完整体积旁边保存面内 1/2、1/4 分辨率的副本（深度不变），
+用于快速概览、渐进式显示和低分辨率预览推理
+"""
+import os
+import glob
+import time
+
+import torch
+import torch.nn.functional as F
+
+DEFAULT_FACTORS = (2, 4)
+
+
+def pyramid_dir(data_dir="preprocessed_data"):
+    return os.path.join(data_dir, "pyramid")
+
+
+def level_path(data_dir, case_name, factor):
+    return os.path.join(pyramid_dir(data_dir), f"{case_name}_x{factor}.pt")
+
+
+def downsample_image(image_tensor, factor):
+    """面内平均下采样 [1, D, H, W] -> [1, D, H/f, W/f]"""
+    if factor == 1:
+        return image_tensor
+    return F.avg_pool3d(image_tensor.unsqueeze(0).float(), kernel_size=(1, factor, factor))[0]
+
+
+def downsample_segmentation(seg_tensor, factor):
+    """面内最近邻下采样（取每个块的中心体素）"""
+    if factor == 1:
+        return seg_tensor
+    offset = factor // 2
+    return seg_tensor[..., offset::factor, offset::factor].contiguous()
+
+
+def save_pyramid(case_name, image_tensor, seg_tensor, data_dir="preprocessed_data",
+                 factors=DEFAULT_FACTORS):
+    """保存金字塔层级：影像 float16，分割 uint8"""
+    os.makedirs(pyramid_dir(data_dir), exist_ok=True)
+    paths = []
+    for factor in factors:
+        path = level_path(data_dir, case_name, factor)
+        torch.save({
+            'image': downsample_image(image_tensor, factor).to(torch.float16),
+            'segmentation': downsample_segmentation(seg_tensor, factor).to(torch.uint8),
+            'case_name': case_name,
+            'factor': factor,
+        }, path)
+        paths.append(path)
+    return paths
+
+
+def available_factors(case_name, data_dir="preprocessed_data"):
+    """该病例已存在的金字塔层级（从粗到细）"""
+    pattern = os.path.join(pyramid_dir(data_dir), f"{case_name}_x*.pt")
+    factors = []
+    for path in glob.glob(pattern):
+        suffix = os.path.splitext(path)[0].rsplit("_x", 1)[-1]
+        if suffix.isdigit():
+            factors.append(int(suffix))
+    return sorted(factors, reverse=True)
+
+
+def load_level(case_name, factor, data_dir="preprocessed_data"):
+    """加载一个金字塔层级，返回 (image float32 [1, D, h, w], segmentation int64 [1, D, h, w])"""
+    data = torch.load(level_path(data_dir, case_name, factor))
+    return data['image'].float(), data['segmentation'].long()
+
+
+def build_missing(data_dir="preprocessed_data", factors=DEFAULT_FACTORS):
+    """为已有的预处理病例补建金字塔"""
+    built = 0
+    for path in sorted(glob.glob(f"{data_dir}/*.pt")):
+        case_name = os.path.splitext(os.path.basename(path))[0]
+        missing = [f for f in factors if not os.path.exists(level_path(data_dir, case_name, f))]
+        if not missing:
+            continue
+        data = torch.load(path)
+        save_pyramid(case_name, data['image'], data['segmentation'], data_dir, missing)
+        built += 1
+        print(f"🔺 已生成金字塔: {case_name} (x{', x'.join(map(str, missing))})")
+    return built
+
+
+def storage_report(data_dir="preprocessed_data"):
+    """统计金字塔相对完整体积的存储开销"""
+    full_bytes = sum(os.path.getsize(p) for p in glob.glob(f"{data_dir}/*.pt"))
+    per_factor = {}
+    for path in glob.glob(os.path.join(pyramid_dir(data_dir), "*_x*.pt")):
+        suffix = os.path.splitext(path)[0].rsplit("_x", 1)[-1]
+        if suffix.isdigit():
+            per_factor[int(suffix)] = per_factor.get(int(suffix), 0) + os.path.getsize(path)
+
+    print(f"💾 完整体积: {full_bytes / 1024 ** 3:.2f} GB")
+    for factor in sorted(per_factor):
+        overhead = per_factor[factor] / full_bytes if full_bytes else float('nan')
+        print(f"  x{factor}: {per_factor[factor] / 1024 ** 2:.1f} MB (+{overhead:.1%})")
+    total = sum(per_factor.values())
+    print(f"  金字塔总开销: +{total / full_bytes:.1%}" if full_bytes else "  没有完整体积")
+    return full_bytes, per_factor
+
+
+def latency_report(case_name, data_dir="preprocessed_data", model=None, factors=DEFAULT_FACTORS, planner=None):
+    """对比完整体积与各层级的加载时间（以及给出模型时的推理时间，按 MemoryPlanner 分块）"""
+    from memory_planner import MemoryPlanner
+    from streaming_inference import StreamingPredictor
+
+    start = time.perf_counter()
+    full = torch.load(f"{data_dir}/{case_name}.pt")
+    timings = {1: {'load': time.perf_counter() - start}}
+    images = {1: full['image']}
+    for factor in factors:
+        start = time.perf_counter()
+        images[factor], _ = load_level(case_name, factor, data_dir)
+        timings[factor] = {'load': time.perf_counter() - start}
+
+    if model is not None:
+        predictor = StreamingPredictor(model, planner=planner or MemoryPlanner(model))
+        for factor, image in images.items():
+            start = time.perf_counter()
+            predictor.predict(image)
+            timings[factor]['predict'] = time.perf_counter() - start
+
+    print(f"⏱️  {case_name} 延迟:")
+    for factor, t in timings.items():
+        text = f"加载 {t['load']:.3f}s"
+        if 'predict' in t:
+            text += f", 推理 {t['predict']:.2f}s"
+        print(f"  x{factor} {tuple(images[factor].shape)}: {text}")
+    return timings
+
+
+if __name__ == "__main__":
+    print(f"🔄 补建金字塔: {build_missing()} 个病例")
+    storage_report()
+    cases = sorted(glob.glob("preprocessed_data/*.pt"))
+    if cases:
+        latency_report(os.path.splitext(os.path.basename(cases[0]))[0])
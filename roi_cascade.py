@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+粗到细 ROI 级联推理
+1. 低分辨率 (默认 64×128×128) 粗略定位肾脏，不需要标注
+2. 只在扩展后的包围盒内做全分辨率推理（两侧再加感受野大小的上下文），结果贴回原体积
+
+注意：粗定位默认直接用全分辨率训练的 KITS23UNetFixed 处理 2×/4×/4× 下采样的输入，
+模型从未在这个尺度上训练过。启用前应使用在粗分辨率上训练的 coarse_model，
+或先用 benchmark_cascade 在真实病例上确认定位没有漏掉肾脏
+"""
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy import ndimage
+
+from streaming_inference import SIZE_MULTIPLE, StreamingPredictor, align_range, fused_uncertainty
+
+
+def _merge_boxes(boxes):
+    """合并相互重叠的包围盒"""
+    boxes = [list(b) for b in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if all(a[k][0] < b[k][1] and b[k][0] < a[k][1] for k in range(3)):
+                    boxes[i] = [(min(a[k][0], b[k][0]), max(a[k][1], b[k][1])) for k in range(3)]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [tuple(b) for b in boxes]
+
+
+class CascadePredictor:
+    """ROI 级联推理，输出格式与 StreamingPredictor 相同
+
+    包围盒内的预测与全体积推理完全一致（每个盒子两侧另加 receptive_halo 的上下文输入）；
+    与全体积推理的差别只来自盒子外被全体积推理判为前景的体素，benchmark_cascade 会报告这部分。
+    粗定位漏掉肾脏时回退到全体积推理，总耗时为粗定位 + 全体积推理，比直接推理更慢
+
+    Args:
+        model: KITS23UNetFixed (eval 模式)
+        coarse_shape: 粗定位阶段的输入尺寸，需为 8 的倍数
+        margin: 全分辨率下每个包围盒在 (D, H, W) 上的扩展体素数，用于容忍粗定位的误差
+        min_component: 粗预测中小于该体素数的连通域视为噪声
+        coarse_model: 粗定位使用的模型，默认为 model（未在粗分辨率上训练，见模块说明）
+        chunk_depth / map_scale / low_confidence / remap_cyst / planner: 同 StreamingPredictor
+    """
+
+    def __init__(self, model, coarse_shape=(64, 128, 128), margin=(8, 32, 32), min_component=20,
+                 chunk_depth=16, map_scale=4, low_confidence=0.5, remap_cyst=True, planner=None,
+                 coarse_model=None):
+        if any(s % SIZE_MULTIPLE for s in coarse_shape):
+            raise ValueError(f"coarse_shape 必须是 {SIZE_MULTIPLE} 的倍数: {coarse_shape}")
+        if SIZE_MULTIPLE % map_scale != 0:
+            raise ValueError(f"map_scale ({map_scale}) 必须整除 {SIZE_MULTIPLE}")
+        self.model = model
+        self.coarse_model = coarse_model or model
+        self.coarse_shape = tuple(coarse_shape)
+        self.margin = tuple(margin)
+        self.min_component = min_component
+        self.map_scale = map_scale
+        self.fine = StreamingPredictor(model, chunk_depth, map_scale, low_confidence, remap_cyst,
+                                       planner=planner)
+        self.low_confidence = low_confidence
+        self.remap_cyst = remap_cyst
+
+    def _coarse_pass(self, image_tensor):
+        """低分辨率推理，返回粗预测 [d, h, w] 和不确定性图"""
+        coarse = F.interpolate(image_tensor.unsqueeze(0).float(), size=self.coarse_shape,
+                               mode='trilinear', align_corners=False)
+        with torch.no_grad():
+            logits = self.coarse_model(coarse)[0]
+            pred, max_softmax, entropy, energy = fused_uncertainty(logits)
+        if self.remap_cyst:
+            pred[pred == 3] = 0
+        maps = {'max_softmax': max_softmax, 'entropy': entropy, 'energy': energy}
+        return pred.numpy(), maps
+
+    def localize(self, image_tensor, coarse_prediction=None):
+        """在没有标注的情况下定位肾脏区域
+
+        Args:
+            image_tensor: [1, D, H, W]
+        Returns:
+            list: 全分辨率包围盒 [((z0, z1), (y0, y1), (x0, x1)), ...]，已扩展、对齐并合并
+        """
+        if coarse_prediction is None:
+            coarse_prediction, _ = self._coarse_pass(image_tensor)
+        full_shape = image_tensor.shape[-3:]
+        scale = [full / coarse for full, coarse in zip(full_shape, self.coarse_shape)]
+
+        components, n = ndimage.label(coarse_prediction > 0)
+        if n == 0:
+            return []
+        sizes = np.bincount(components.ravel())
+        boxes = []
+        for label, box in enumerate(ndimage.find_objects(components), 1):
+            if box is None or sizes[label] < self.min_component:
+                continue
+            full_box = []
+            for axis, sl in enumerate(box):
+                start = int(np.floor(sl.start * scale[axis])) - self.margin[axis]
+                end = int(np.ceil(sl.stop * scale[axis])) + self.margin[axis]
+                full_box.append(align_range(max(0, start), min(full_shape[axis], end), full_shape[axis]))
+            boxes.append(tuple(full_box))
+
+        # 合并后再对齐一次，保证合并出的盒子尺寸仍为 8 的倍数
+        return [tuple(align_range(s, e, full_shape[axis]) for axis, (s, e) in enumerate(box))
+                for box in _merge_boxes(boxes)]
+
+    def predict(self, image_tensor):
+        """
+        Args:
+            image_tensor: [1, D, H, W]
+        Returns:
+            dict: 见 UncertaintyAccumulator.result。ROI 外预测为背景，
+                  不确定性图取自粗定位阶段；mean_* 分数由低分辨率图估计
+        """
+        full_shape = tuple(image_tensor.shape[-3:])
+        coarse_prediction, coarse_maps = self._coarse_pass(image_tensor)
+        boxes = self.localize(image_tensor, coarse_prediction)
+
+        if not boxes:
+            print("⚠️  粗定位未找到肾脏区域，回退到全体积推理（比直接推理多一次粗定位）")
+            result = self.fine.predict(image_tensor)
+            result['scores'].update({'n_rois': 0, 'roi_fraction': 1.0})
+            return result
+
+        s = self.map_scale
+        map_shape = tuple(-(-size // s) for size in full_shape)
+        maps = {name: F.interpolate(m[None, None], size=map_shape, mode='trilinear',
+                                    align_corners=False)[0, 0].to(torch.float16)
+                for name, m in coarse_maps.items()}
+        prediction = torch.zeros(full_shape, dtype=torch.uint8)
+
+        fg_voxels = 0
+        fg_sums = {}
+        roi_voxels = 0
+        for box in boxes:
+            region = tuple(slice(start, end) for start, end in box)
+            map_region = tuple(slice(start // s, -(-end // s)) for start, end in box)
+            # 盒子外再加感受野大小的上下文，只保留盒子内的结果，盒子边缘与全体积推理一致
+            context = tuple(align_range(max(0, start - h), min(size, end + h), size)
+                            for (start, end), h, size in zip(box, self.fine.halo, full_shape))
+            crop = tuple((start - lo, end - lo) for (start, end), (lo, _) in zip(box, context))
+            sub = self.fine.predict(image_tensor[(slice(None),) + tuple(slice(lo, hi) for lo, hi in context)], crop)
+
+            prediction[region] = sub['prediction']
+            for name, m in sub['maps'].items():
+                maps[name][map_region] = m
+
+            roi_voxels += sub['prediction'].numel()
+            n_fg = int((sub['prediction'] > 0).sum())
+            fg_voxels += n_fg
+            for name in coarse_maps:
+                value = sub['scores'][f"foreground_{name}"]
+                if n_fg:
+                    fg_sums[name] = fg_sums.get(name, 0.0) + value * n_fg
+
+        total = prediction.numel()
+        scores = {f"mean_{name}": float(m.float().mean()) for name, m in maps.items()}
+        for name in coarse_maps:
+            scores[f"foreground_{name}"] = fg_sums[name] / fg_voxels if fg_voxels else float('nan')
+        scores['low_confidence_fraction'] = float((maps['max_softmax'] < self.low_confidence).float().mean())
+        scores['foreground_fraction'] = fg_voxels / total
+        scores['n_rois'] = len(boxes)
+        scores['roi_fraction'] = roi_voxels / total
+
+        return {'prediction': prediction, 'maps': maps, 'scores': scores, 'rois': boxes}
+
+
+def benchmark_cascade(model, image_tensor, planner=None, **kwargs):
+    """对比全体积推理与 ROI 级联推理的耗时和结果一致性
+
+    两条路径使用同一个 MemoryPlanner（默认按 default_budget_gb 创建）选择分块
+    """
+    from evaluate_segmentation import confusion_matrix, overlap_metrics
+    from memory_planner import MemoryPlanner
+
+    if planner is None:
+        planner = MemoryPlanner(model)
+
+    start = time.perf_counter()
+    full = StreamingPredictor(model, planner=planner).predict(image_tensor)
+    full_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cascade = CascadePredictor(model, planner=planner, **kwargs).predict(image_tensor)
+    cascade_seconds = time.perf_counter() - start
+
+    full_prediction = full['prediction'].numpy()
+    cascade_prediction = cascade['prediction'].numpy()
+    dice = overlap_metrics(confusion_matrix(full_prediction, cascade_prediction))['dice']
+    inside = np.zeros(full_prediction.shape, dtype=bool)
+    for box in cascade.get('rois', []):
+        inside[tuple(slice(start, end) for start, end in box)] = True
+    # 回退到全体积推理时没有 ROI，结果与全体积推理相同
+    missed = int(((full_prediction > 0) & ~inside).sum()) if inside.any() else 0
+    inside_agreement = float((full_prediction[inside] == cascade_prediction[inside]).mean()) \
+        if inside.any() else 1.0
+    print(f"⏱️  全体积: {full_seconds:.2f}s, 级联: {cascade_seconds:.2f}s "
+          f"(加速 {full_seconds / cascade_seconds:.1f}x)")
+    print(f"📦 ROI: {cascade['scores']['n_rois']} 个, 覆盖 {cascade['scores']['roi_fraction']:.1%} 体素")
+    print(f"📐 与全体积预测的一致性 Dice: kidney={dice[1]:.3f}, tumor={dice[2]:.3f}; "
+          f"ROI 内一致率 {inside_agreement:.2%}, ROI 外被全体积推理判为前景 {missed} 体素")
+    return full_seconds, cascade_seconds
+
+
+if __name__ == "__main__":
+    from create_dataloader import KITS23Dataset
+    from kits23_unet_fixed import load_trained_model
+
+    model = load_trained_model()
+
+    image, _ = KITS23Dataset()[0]
+    benchmark_cascade(model, image)
@@ -86,8 +86,12 @@ class KITS23Preprocessor:
         
         return resized.squeeze().numpy()
     
-    def preprocess(self, imaging_path, segmentation_path):
-        """完整的预处理流程"""
+    def preprocess(self, imaging_path, segmentation_path, return_info=False):
+        """完整的预处理流程
+
+        Args:
+            return_info: 额外返回 {'roi', 'original_shape', 'spacing'}，供病例目录使用
+        """
         print(f"\n📁 处理病例: {os.path.basename(os.path.dirname(imaging_path))}")
         print("-" * 50)
         
@@ -130,6 +134,13 @@ class KITS23Preprocessor:
         print(f"  影像: {imaging_tensor.shape} (范围: [{imaging_tensor.min():.3f}, {imaging_tensor.max():.3f}])")
         print(f"  分割: {segmentation_tensor.shape} (标签: {torch.unique(segmentation_tensor).tolist()})")
         
+        if return_info:
+            info = {
+                'roi': roi,
+                'original_shape': imaging_data.shape,
+                'spacing': imaging.header.get_zooms(),
+            }
+            return imaging_tensor, segmentation_tensor, info
         return imaging_tensor, segmentation_tensor
 
 def main():
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+流式推理 - argmax 与逐体素不确定性融合计算
+沿深度分块处理 logits，不生成完整的 softmax 概率体积，
+只保存 uint8 预测、float16 低分辨率不确定性图和病例级 OOD 分数
+"""
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# KITS23UNetFixed 需要三个方向的尺寸都能被 8 整除（stride-2 卷积 + 两次池化）
+SIZE_MULTIPLE = 8
+
+
+def align_range(start, end, size, step=SIZE_MULTIPLE):
+    """把区间扩展到 step 的整数倍，并限制在 [0, size) 内"""
+    start = (start // step) * step
+    end = min(size, -(-end // step) * step)
+    length = -(-(end - start) // step) * step
+    start = max(0, end - length)
+    return start, end
+
+
+def receptive_halo(model, size=128, plane=16):
+    """模型在 (D, H, W) 三个方向的感受野半径，各自向上取整到 SIZE_MULTIPLE
+
+    在模型副本上把卷积权重设为 1、偏置设为 0、BatchNorm 设为恒等，所有激活非负，
+    输入一个垂直于该方向的脉冲平面后，输出中非零的范围就是它能影响的范围（可达性，不受权重取值影响）。
+    每个方向对 SIZE_MULTIPLE 个相位各测一次取最大值
+    """
+    probe = copy.deepcopy(model).to(device='cpu', dtype=torch.float64).eval()
+    with torch.no_grad():
+        for module in probe.modules():
+            if isinstance(module, (nn.Conv3d, nn.ConvTranspose3d)):
+                module.weight.fill_(1.0)
+                if module.bias is not None:
+                    module.bias.zero_()
+            elif isinstance(module, nn.modules.batchnorm._BatchNorm):
+                module.reset_parameters()
+
+        halo = []
+        for axis in range(3):
+            length = size
+            while True:
+                radius = 0
+                center = length // 2
+                shape = [plane, plane, plane]
+                shape[axis] = length
+                other = tuple(a for a in range(1, 4) if a != axis + 1)
+                for phase in range(SIZE_MULTIPLE):
+                    x = torch.zeros([1, 1] + shape, dtype=torch.float64)
+                    x[0, 0].select(axis, center + phase).fill_(1.0)
+                    reached = torch.nonzero(probe(x)[0].abs().sum(dim=(0,) + other) > 0).flatten()
+                    first, last = int(reached.min()), int(reached.max())
+                    radius = max(radius, center + phase - first, last - center - phase)
+                if first > 0 and last < length - 1:
+                    break
+                length *= 2  # 感受野碰到了边界，加大探测尺寸
+            halo.append(-(-radius // SIZE_MULTIPLE) * SIZE_MULTIPLE)
+    return tuple(halo)
+
+
+def tile_ranges(size, tile, halo):
+    """一个方向上的分块: [(t0, t1, lo, hi), ...]
+
+    [t0, t1) 是保留的输出范围，[lo, hi) 是实际前向的输入范围（两侧各加 halo 并对齐到 8 的倍数）；
+    tile 为 None 或不小于 size 时整个方向一次前向
+    """
+    if tile is None or tile >= size:
+        return [(0, size, 0, size)]
+    ranges = []
+    for t0 in range(0, size, tile):
+        t1 = min(t0 + tile, size)
+        lo, hi = align_range(max(0, t0 - halo), min(size, t1 + halo), size)
+        ranges.append((t0, t1, lo, hi))
+    return ranges
+
+
+def _per_axis(halo):
+    return tuple(halo) if isinstance(halo, (tuple, list)) else (halo,) * 3
+
+
+def tiled_logit_slabs(model, image_tensor, tile_shape, halo, chunk_depth):
+    """按 (D, H, W) 分块前向，生成 (z0, z1, logits[C, d, H, W])
+
+    每块前向输入在三个方向上各扩展 halo（int 或每个方向一个值），只保留中心部分；
+    halo 不小于感受野半径时与整体前向结果一致。面内也分块时，
+    一个深度分块的各面内分块先拼回 [C, tile_depth, H, W] 再输出；同一时刻只有一个深度分块的 logits 存活
+    """
+    shape = tuple(image_tensor.shape[-3:])
+    tile_shape = (None,) * 3 if tile_shape is None else tuple(tile_shape)
+    halo = _per_axis(halo)
+    rows = tile_ranges(shape[1], tile_shape[1], halo[1])
+    cols = tile_ranges(shape[2], tile_shape[2], halo[2])
+
+    for t0, t1, z_lo, z_hi in tile_ranges(shape[0], tile_shape[0], halo[0]):
+        if len(rows) == 1 and len(cols) == 1:
+            logits = model(image_tensor[:, z_lo:z_hi].unsqueeze(0).float())[0][:, t0 - z_lo:t1 - z_lo]
+        else:
+            logits = None
+            for y0, y1, y_lo, y_hi in rows:
+                for x0, x1, x_lo, x_hi in cols:
+                    block = image_tensor[:, z_lo:z_hi, y_lo:y_hi, x_lo:x_hi].unsqueeze(0).float()
+                    out = model(block)[0]
+                    if logits is None:
+                        logits = out.new_empty((out.shape[0], t1 - t0) + shape[1:])
+                    logits[:, :, y0:y1, x0:x1] = out[:, t0 - z_lo:t1 - z_lo, y0 - y_lo:y1 - y_lo, x0 - x_lo:x1 - x_lo]
+                    del block, out
+        for z0 in range(t0, t1, chunk_depth):
+            z1 = min(z0 + chunk_depth, t1)
+            yield z0, z1, logits[:, z0 - t0:z1 - t0]
+        del logits
+
+
+def fused_uncertainty(logits):
+    """一个 logits 块上的 argmax + 不确定性
+
+    Args:
+        logits: [C, d, H, W]
+    Returns:
+        prediction [d, H, W] (uint8), max_softmax, entropy, energy [d, H, W] (float32)
+    """
+    lse = torch.logsumexp(logits, dim=0)
+    max_logit, prediction = logits.max(dim=0)
+    max_softmax = torch.exp(max_logit - lse)
+
+    # 熵 = lse - Σ p_c * l_c，逐类别累加，不保存完整的概率张量
+    expected_logit = torch.zeros_like(lse)
+    for c in range(logits.shape[0]):
+        expected_logit += torch.exp(logits[c] - lse) * logits[c]
+    entropy = lse - expected_logit
+
+    # 能量分数 (T=1)：越大越像 OOD
+    energy = -lse
+    return prediction.to(torch.uint8), max_softmax, entropy, energy
+
+
+class UncertaintyAccumulator:
+    """按深度块累积预测、低分辨率不确定性图和病例级分数
+
+    Args:
+        shape: (D, H, W)
+        map_scale: 不确定性图在三个方向上的下采样倍数
+        low_confidence: max_softmax 低于该阈值的体素计为低置信度
+    """
+
+    def __init__(self, shape, map_scale=4, low_confidence=0.5):
+        self.shape = tuple(shape)
+        self.map_scale = map_scale
+        self.low_confidence = low_confidence
+        self.prediction = torch.empty(self.shape, dtype=torch.uint8)
+        self.map_chunks = {}
+        self.sums = {}
+        self.fg_sums = {}
+        self.fg_voxels = 0
+        self.low_conf_voxels = 0
+
+    def _downsample(self, volume):
+        s = self.map_scale
+        pooled = F.avg_pool3d(volume[None, None], kernel_size=s, stride=s, ceil_mode=True)
+        return pooled[0, 0].to(torch.float16)
+
+    def add(self, z0, z1, pred, maps):
+        """
+        Args:
+            pred: [d, H, W] uint8
+            maps: {名称: [d, H, W] float32}，必须包含 max_softmax
+        """
+        self.prediction[z0:z1] = pred
+        foreground = pred > 0
+        self.fg_voxels += int(foreground.sum())
+        self.low_conf_voxels += int((maps['max_softmax'] < self.low_confidence).sum())
+        for name, values in maps.items():
+            self.sums[name] = self.sums.get(name, 0.0) + float(values.sum(dtype=torch.float64))
+            self.fg_sums[name] = self.fg_sums.get(name, 0.0) + \
+                float(values[foreground].sum(dtype=torch.float64))
+            self.map_chunks.setdefault(name, []).append(self._downsample(values))
+
+    def result(self):
+        """
+        Returns:
+            dict: prediction [D, H, W] uint8,
+                  maps {名称: 低分辨率 float16},
+                  scores 病例级 OOD 分数 (float)
+        """
+        total = self.prediction.numel()
+        scores = {f"mean_{name}": value / total for name, value in self.sums.items()}
+        for name, value in self.fg_sums.items():
+            scores[f"foreground_{name}"] = value / self.fg_voxels if self.fg_voxels else float('nan')
+        scores['low_confidence_fraction'] = self.low_conf_voxels / total
+        scores['foreground_fraction'] = self.fg_voxels / total
+
+        return {
+            'prediction': self.prediction,
+            'maps': {name: torch.cat(chunks) for name, chunks in self.map_chunks.items()},
+            'scores': scores,
+        }
+
+
+class StreamingPredictor:
+    """对整个病例做分块 argmax + 不确定性推理
+
+    Args:
+        model: KITS23UNetFixed (eval 模式)
+        chunk_depth: 每次处理的切片数
+        map_scale: 不确定性图在三个方向上的下采样倍数
+        low_confidence: max_softmax 低于该阈值的体素计为低置信度
+        remap_cyst: 将类别3映射为背景（与原 predict_case 行为一致）
+        tile_depth: 每次前向的深度（chunk_depth 的倍数），None 表示整个体积一次前向
+        halo: 分块前向时每个方向两侧额外输入的体素数（int 或 (D, H, W)），结果只保留分块中心部分；
+              None 时取模型的感受野半径（见 receptive_halo），分块结果与整体前向一致。
+              小于感受野时分块接缝附近的预测会与整体前向不同
+        planner: MemoryPlanner，给出时按内存预算自动选择三维分块（深度和面内）
+    """
+
+    def __init__(self, model, chunk_depth=16, map_scale=4, low_confidence=0.5, remap_cyst=True,
+                 tile_depth=None, halo=None, planner=None):
+        if chunk_depth % map_scale != 0:
+            raise ValueError(f"chunk_depth ({chunk_depth}) 必须是 map_scale ({map_scale}) 的整数倍")
+        if tile_depth is not None and tile_depth % chunk_depth != 0:
+            raise ValueError(f"tile_depth ({tile_depth}) 必须是 chunk_depth ({chunk_depth}) 的整数倍")
+        self.model = model
+        self.chunk_depth = chunk_depth
+        self.map_scale = map_scale
+        self.low_confidence = low_confidence
+        self.remap_cyst = remap_cyst
+        self.tile_depth = tile_depth
+        self._halo = halo
+        self.planner = planner
+
+    @property
+    def halo(self):
+        if self._halo is None:
+            self._halo = receptive_halo(self.model)
+        return _per_axis(self._halo)
+
+    def _tile_shape(self, image_tensor):
+        if self.tile_depth is None and self.planner is not None:
+            plan = self.planner.plan_inference(tuple(image_tensor.shape[-3:]), self.halo, self.chunk_depth)
+            return plan['tile_shape']
+        return None if self.tile_depth is None else (self.tile_depth, None, None)
+
+    def _logit_slabs(self, image_tensor):
+        """生成 (z0, z1, logits[C, d, H, W])，需要时分块前向"""
+        tile_shape = self._tile_shape(image_tensor)
+        halo = self.halo if tile_shape is not None else 0
+        return tiled_logit_slabs(self.model, image_tensor, tile_shape, halo, self.chunk_depth)
+
+    def predict(self, image_tensor, crop=None):
+        """
+        Args:
+            image_tensor: [1, D, H, W]
+            crop: ((z0, z1), (y0, y1), (x0, x1))，只输出该区域的结果，区域外的输入只作为上下文；
+                  边界需为 map_scale 的倍数。None 表示整个体积
+        Returns:
+            dict: 见 UncertaintyAccumulator.result（crop 时为该区域的结果）
+        """
+        if crop is None:
+            crop = tuple((0, size) for size in image_tensor.shape[-3:])
+        (c0, c1), (y0, y1), (x0, x1) = crop
+        accumulator = UncertaintyAccumulator((c1 - c0, y1 - y0, x1 - x0), self.map_scale, self.low_confidence)
+        with torch.no_grad():
+            for z0, z1, logits in self._logit_slabs(image_tensor):
+                lo, hi = max(z0, c0), min(z1, c1)
+                if lo >= hi:
+                    continue
+                pred, max_softmax, entropy, energy = fused_uncertainty(logits[:, lo - z0:hi - z0, y0:y1, x0:x1])
+                if self.remap_cyst:
+                    pred[pred == 3] = 0
+                accumulator.add(lo - c0, hi - c0, pred, {
+                    'max_softmax': max_softmax,
+                    'entropy': entropy,
+                    'energy': energy,
+                })
+        return accumulator.result()
+
+
+def save_result(result, path):
+    """保存预测结果（uint8 + float16，不含概率体积）"""
+    torch.save({
+        'prediction': result['prediction'].to(torch.uint8),
+        'maps': {name: m.to(torch.float16) for name, m in result['maps'].items()},
+        'scores': result['scores'],
+    }, path)
+
+
+def test_streaming_predictor():
+    """与完整 logits / softmax 计算对比"""
+    from kits23_unet_fixed import KITS23UNetFixed
+
+    print("🔍 测试流式推理...")
+    model = KITS23UNetFixed().eval()
+    image = torch.rand(1, 32, 64, 64)
+
+    with torch.no_grad():
+        logits = model(image.unsqueeze(0))[0]
+        probabilities = F.softmax(logits, dim=0)
+        # softmax 单调，argmax 直接在 logits 上做（避免概率舍入造成的并列）
+        reference = torch.argmax(logits, dim=0)
+        reference[reference == 3] = 0
+        ref_entropy = -(probabilities * torch.log(probabilities)).sum(0).mean()
+
+    result = StreamingPredictor(model, chunk_depth=8).predict(image)
+    assert torch.equal(result['prediction'].long(), reference)
+    assert abs(result['scores']['mean_entropy'] - float(ref_entropy)) < 1e-4
+    print(f"✅ 预测一致, OOD 分数: {result['scores']}")
+    print(f"📊 不确定性图尺寸: {result['maps']['entropy'].shape} ({result['maps']['entropy'].dtype})")
+
+    # 分块前向：halo 取感受野半径时与整体推理一致；halo 过小时接缝附近会变化
+    halo = receptive_halo(model)
+    image = torch.rand(1, 128, 32, 32)
+    with torch.no_grad():
+        reference = model(image.unsqueeze(0))[0]
+    full = StreamingPredictor(model, chunk_depth=8).predict(image)
+    tiled = StreamingPredictor(model, chunk_depth=8, tile_depth=16).predict(image)
+    with torch.no_grad():
+        slabs = torch.cat([logits for _, _, logits in tiled_logit_slabs(model, image, (16, None, None), halo, 8)],
+                          dim=1)
+    assert torch.allclose(slabs, reference, atol=1e-4)
+    assert torch.equal(tiled['prediction'], full['prediction'])
+    short = StreamingPredictor(model, chunk_depth=8, tile_depth=16, halo=8).predict(image)
+    agreement = float((short['prediction'] == full['prediction']).float().mean())
+
+    # 面内也分块 (深度 32 × 面内 48)
+    image = torch.rand(1, 64, 128, 128)
+    with torch.no_grad():
+        reference = model(image.unsqueeze(0))[0]
+        slabs = torch.cat([logits for _, _, logits in tiled_logit_slabs(model, image, (32, 48, 48), halo, 8)],
+                          dim=1)
+    assert torch.allclose(slabs, reference, atol=1e-4)
+    print(f"🧩 分块推理 (深度 / 深度+面内): halo={halo} 与整体推理一致, 深度 halo=8 一致率 {agreement:.2%}")
+
+
+if __name__ == "__main__":
+    test_streaming_predictor()
@@ -0,0 +1,73 @@
+# test_evaluate_segmentation.py
+import io
+from contextlib import redirect_stdout
+
+import numpy as np
+from scipy import ndimage
+
+from evaluate_segmentation import CohortEvaluator, _evaluate_job, confusion_matrix, surface_metrics
+
+
+def _reference_surface_metrics(gt_mask, pred_mask, spacing=None):
+    """不裁剪包围盒、在整个体积上做距离变换的参考实现"""
+    gt_surface = gt_mask & ~ndimage.binary_erosion(gt_mask)
+    pred_surface = pred_mask & ~ndimage.binary_erosion(pred_mask)
+    pred_to_gt = ndimage.distance_transform_edt(~gt_surface, sampling=spacing)[pred_surface]
+    gt_to_pred = ndimage.distance_transform_edt(~pred_surface, sampling=spacing)[gt_surface]
+    hd95 = max(np.percentile(pred_to_gt, 95), np.percentile(gt_to_pred, 95))
+    assd = (pred_to_gt.sum() + gt_to_pred.sum()) / (len(pred_to_gt) + len(gt_to_pred))
+    return hd95, assd
+
+
+def _random_blob(rng, shape, center, radius):
+    grid = np.indices(shape)
+    distance = sum(((g - c) / r) ** 2 for g, c, r in zip(grid, center, radius))
+    return distance + rng.uniform(-0.3, 0.3, shape) < 1
+
+
+def test_confusion_matrix():
+    print("🧪 测试分块混淆矩阵...")
+    rng = np.random.default_rng(0)
+    gt = rng.integers(0, 4, (37, 20, 24))
+    pred = rng.integers(0, 4, (37, 20, 24))
+    reference = np.zeros((4, 4), dtype=np.int64)
+    np.add.at(reference, (gt.ravel(), pred.ravel()), 1)
+    assert np.array_equal(confusion_matrix(gt, pred, chunk_depth=8), reference)
+
+
+def test_surface_metrics_match_uncropped_reference():
+    print("🧪 测试包围盒裁剪的 HD95 / ASSD...")
+    rng = np.random.default_rng(1)
+    shape = (40, 64, 64)
+    for spacing in (None, (3.0, 0.8, 0.8)):
+        for pred_center in ((20, 30, 30), (24, 38, 26), (10, 50, 50)):
+            gt = _random_blob(rng, shape, (20, 30, 30), (8, 12, 10))
+            pred = _random_blob(rng, shape, pred_center, (7, 10, 12))
+            hd95, assd = surface_metrics(gt, pred, spacing)
+            ref_hd95, ref_assd = _reference_surface_metrics(gt, pred, spacing)
+            assert np.isclose(hd95, ref_hd95) and np.isclose(assd, ref_assd), \
+                (spacing, pred_center, hd95, ref_hd95, assd, ref_assd)
+
+    empty = np.zeros(shape, dtype=bool)
+    assert all(np.isnan(v) for v in surface_metrics(empty, empty))
+    assert all(np.isinf(v) for v in surface_metrics(gt, empty))
+
+
+def test_summary_separates_surface_units():
+    print("🧪 测试 mm / 体素 分组汇总...")
+    gt = np.zeros((16, 16, 16), dtype=np.uint8)
+    gt[4:10, 4:10, 4:10] = 1
+    pred = np.roll(gt, 2, axis=2)
+    rows = _evaluate_job('a', gt, pred, 4, (2.0, 1.0, 1.0), True) + _evaluate_job('b', gt, pred, 4, None, True)
+    output = io.StringIO()
+    with redirect_stdout(output):
+        CohortEvaluator.print_summary(rows)
+    kidney_lines = output.getvalue().split("kidney:")[1].split("tumor:")[0]
+    assert "mm (1 例)" in kidney_lines and "体素 (1 例)" in kidney_lines
+
+
+if __name__ == "__main__":
+    test_confusion_matrix()
+    test_surface_metrics_match_uncropped_reference()
+    test_summary_separates_surface_units()
+    print("✅ 指标测试通过")
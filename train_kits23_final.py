@@ -2,25 +2,50 @@
 """
 KITS23 专用训练脚本 - 使用修复后的UNet
 """
+import os
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
+from case_catalog import CaseCatalog
 from create_dataloader import KITS23Dataset
 from kits23_unet_fixed import KITS23UNetFixed
+from memory_planner import MemoryPlanner
+
+def split_cases(data_dir="preprocessed_data", val_fraction=0.2, seed=42):
+    """从病例目录得到分层的训练/验证划分；没有目录时全部用于训练"""
+    catalog_path = f"{data_dir}/catalog.sqlite"
+    if not os.path.exists(catalog_path):
+        print("⚠️  没有病例目录 (运行 python case_catalog.py)，不划分验证集")
+        return None, []
+    catalog = CaseCatalog(catalog_path)
+    train_names, val_names = catalog.stratified_split(val_fraction, seed)
+    catalog.close()
+    return train_names, val_names
+
 
 def main():
     print("🚀 启动 KITS23 训练 (修复版UNet)...")
     print("=" * 50)
     
-    # 1. 数据加载
-    dataset = KITS23Dataset()
-    dataloader = DataLoader(dataset, batch_size=2, shuffle=True)
+    # 1. 模型和内存规划（按内存预算选择 batch size 和 patch 尺寸）
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = KITS23UNetFixed()
+    plan = MemoryPlanner(model, device=device).plan_training((128, 512, 512))
+    model = model.to(device)
+    print(f"🧮 训练计划: batch={plan['batch_size']}, patch={plan['patch_size']}, "
+          f"预计峰值 {plan['peak_gb']:.1f} GB")
     
-    print(f"📊 训练病例: {len(dataset)} 个")
+    # 2. 数据加载（按是否有肿瘤/囊肿分层划分训练/验证集）
+    train_names, val_names = split_cases()
+    dataset = KITS23Dataset(cases=train_names, patch_size=plan['patch_size'])
+    dataloader = DataLoader(dataset, batch_size=plan['batch_size'], shuffle=True)
+    # 验证同样使用规划的 patch 尺寸，保证不超出内存预算；固定中心裁剪，各 epoch 的验证损失可比
+    val_loader = None
+    if val_names:
+        val_dataset = KITS23Dataset(cases=val_names, patch_size=plan['patch_size'], random_crop=False)
+        val_loader = DataLoader(val_dataset, batch_size=plan['batch_size'], shuffle=False)
     
-    # 2. 模型和设备
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = KITS23UNetFixed().to(device)
+    print(f"📊 训练病例: {len(dataset)} 个, 验证病例: {len(val_names)} 个")
     
     # 3. 训练配置
     optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
@@ -55,6 +80,16 @@ def main():
         
         avg_loss = total_loss / len(dataloader)
         print(f"🎯 Epoch {epoch+1} 完成, 平均损失: {avg_loss:.4f}")
+        
+        if val_loader is not None:
+            model.eval()
+            val_loss = 0
+            with torch.no_grad():
+                for images, masks in val_loader:
+                    outputs = model(images.to(device))
+                    val_loss += criterion(outputs, masks.to(device).squeeze(1)).item()
+            model.train()
+            print(f"🧪 Epoch {epoch+1} 验证损失: {val_loss / len(val_loader):.4f}")
         print("-" * 40)
     
     # 保存模型
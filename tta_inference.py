@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+批量测试时增强 (TTA) - 流式累积均值/方差
+增强视图按内存预算分组成批次前向，逐视图逆变换后
+用 Welford 算法原地更新概率的均值和方差，不保存 N 份完整概率体积
+"""
+import time
+
+import torch
+
+from streaming_inference import UncertaintyAccumulator, receptive_halo, tiled_logit_slabs
+
+# 每个视图: (翻转维度, 强度增益)，维度对应 [D, H, W] = (1, 2, 3)（在 [C, D, H, W] 上）
+DEFAULT_VIEWS = [
+    ((), 1.0),
+    ((3,), 1.0),        # 左右翻转
+    ((2,), 1.0),        # 前后翻转
+    ((2, 3), 1.0),
+    ((), 0.9),          # 强度缩放
+    ((), 1.1),
+    ((1,), 1.0),        # 头脚翻转
+    ((3,), 1.1),
+]
+
+# 前向传播的峰值内存约为 输入体素数 × 该系数 × 4 字节（float32 激活）
+ACTIVATION_FLOATS_PER_VOXEL = 24
+
+
+def make_views(n_views):
+    """取前 n 个默认视图（第一个总是原图）"""
+    if not 1 <= n_views <= len(DEFAULT_VIEWS):
+        raise ValueError(f"n_views 必须在 1-{len(DEFAULT_VIEWS)} 之间: {n_views}")
+    return DEFAULT_VIEWS[:n_views]
+
+
+class TTAPredictor:
+    """测试时增强推理，输出格式与 StreamingPredictor 相同
+
+    Args:
+        model: KITS23UNetFixed (eval 模式)
+        views: [(flip_dims, gain), ...]，默认取 4 个视图
+        memory_budget_gb: 一次批量前向允许使用的内存
+        planner: MemoryPlanner，给出时按层图估计选择每批视图数（忽略 memory_budget_gb）；
+                 单个视图也放不下时，每个视图按 StreamingPredictor 的方式三维分块前向
+        chunk_depth / map_scale / low_confidence / remap_cyst: 同 StreamingPredictor
+    """
+
+    def __init__(self, model, views=None, memory_budget_gb=4.0, chunk_depth=16, map_scale=4,
+                 low_confidence=0.5, remap_cyst=True, planner=None):
+        if chunk_depth % map_scale != 0:
+            raise ValueError(f"chunk_depth ({chunk_depth}) 必须是 map_scale ({map_scale}) 的整数倍")
+        self.model = model
+        self.views = views or make_views(4)
+        self.memory_budget_gb = memory_budget_gb
+        self.chunk_depth = chunk_depth
+        self.map_scale = map_scale
+        self.low_confidence = low_confidence
+        self.remap_cyst = remap_cyst
+        self.planner = planner
+        self._halo = None
+
+    @staticmethod
+    def _reserved_bytes(image_shape):
+        """前向期间常驻的 Welford 均值与 M2: 2 × [C=4, D, H, W] float32"""
+        voxels = 1
+        for size in image_shape[-3:]:
+            voxels *= size
+        return 2 * 4 * voxels * 4
+
+    def views_per_batch(self, image_shape):
+        """在内存预算内一次前向可以容纳的视图数"""
+        voxels = 1
+        for size in image_shape[-3:]:
+            voxels *= size
+        if self.planner is not None:
+            reserved = self._reserved_bytes(image_shape)
+            return self.planner.max_batch(tuple(image_shape[-3:]), len(self.views), 'infer', reserved)
+        bytes_per_view = voxels * ACTIVATION_FLOATS_PER_VOXEL * 4
+        fit = int(self.memory_budget_gb * 1024 ** 3 // bytes_per_view)
+        return max(1, min(len(self.views), fit))
+
+    @staticmethod
+    def _augment(image_tensor, view):
+        flip_dims, gain = view
+        x = image_tensor.float()
+        if flip_dims:
+            x = x.flip(flip_dims)
+        if gain != 1.0:
+            x = (x * gain).clamp_(0, 1)
+        return x
+
+    def view_tile_shape(self, image_shape):
+        """单个视图整体前向超出预算时的分块尺寸 (D, H, W)，放得下时为 None"""
+        if self.planner is None:
+            return None
+        shape = tuple(image_shape[-3:])
+        reserved = self._reserved_bytes(shape)
+        if self.planner.fits(shape, 1, 'infer', reserved):
+            return None
+        if self._halo is None:
+            self._halo = receptive_halo(self.model)
+        # 分块时还要常驻该视图拼接后的 logits 及其翻转副本: 2 × [C=4, D, H, W] float32
+        plan = self.planner.plan_inference(shape, self._halo, self.chunk_depth, 2 * reserved)
+        return plan['tile_shape']
+
+    def _forward_tiled(self, image_tensor, tile_shape):
+        """逐视图分块前向，生成每个视图的 logits（已逆变换到原始方向）"""
+        for view in self.views:
+            x = self._augment(image_tensor, view)
+            logits = None
+            for z0, z1, slab in tiled_logit_slabs(self.model, x, tile_shape, self._halo, self.chunk_depth):
+                if logits is None:
+                    logits = slab.new_empty((slab.shape[0],) + tuple(x.shape[-3:]))
+                logits[:, z0:z1] = slab
+            del x
+            flip_dims = view[0]
+            yield logits.flip(flip_dims) if flip_dims else logits
+            del logits
+
+    def _forward_views(self, image_tensor):
+        """按批次生成每个视图的 logits（已逆变换到原始方向）"""
+        tile_shape = self.view_tile_shape(image_tensor.shape)
+        if tile_shape is not None:
+            print(f"🧩 单个 TTA 视图超出内存预算，分块前向 (分块 {tile_shape}, halo={self._halo})")
+            yield from self._forward_tiled(image_tensor, tile_shape)
+            return
+        batch_size = self.views_per_batch(image_tensor.shape)
+        for start in range(0, len(self.views), batch_size):
+            batch_views = self.views[start:start + batch_size]
+            batch = torch.stack([self._augment(image_tensor, v) for v in batch_views])
+            logits = self.model(batch)
+            del batch
+            for i, (flip_dims, _) in enumerate(batch_views):
+                yield logits[i].flip(flip_dims) if flip_dims else logits[i]
+            del logits
+
+    def predict(self, image_tensor):
+        """
+        Args:
+            image_tensor: [1, D, H, W]
+        Returns:
+            dict: 见 UncertaintyAccumulator.result，额外的 maps/scores 项 'variance'
+                  为各类别概率在视图间的平均方差
+        """
+        mean = None
+        m2 = None
+        energy = None
+        n = 0
+
+        with torch.no_grad():
+            for logits in self._forward_views(image_tensor):
+                n += 1
+                # logits -> 概率，原地完成
+                lse = torch.logsumexp(logits, dim=0)
+                probabilities = logits.sub_(lse).exp_()
+
+                if mean is None:
+                    mean = probabilities.clone()
+                    m2 = torch.zeros_like(mean)
+                    energy = lse.neg_()
+                    continue
+
+                # Welford: mean += δ/n, m2 += δ * (x - mean_new)
+                delta = probabilities.sub_(mean)
+                mean.add_(delta, alpha=1.0 / n)
+                m2.addcmul_(delta, delta, value=(n - 1) / n)
+                energy.add_(lse.neg_().sub_(energy), alpha=1.0 / n)
+                del probabilities, delta
+
+        variance = m2.div_(max(n - 1, 1))
+        del m2
+
+        accumulator = UncertaintyAccumulator(image_tensor.shape[-3:], self.map_scale, self.low_confidence)
+        for z0 in range(0, mean.shape[1], self.chunk_depth):
+            z1 = min(z0 + self.chunk_depth, mean.shape[1])
+            p = mean[:, z0:z1]
+            max_softmax, pred = p.max(dim=0)
+            pred = pred.to(torch.uint8)
+            if self.remap_cyst:
+                pred[pred == 3] = 0
+            entropy = -(p * torch.log(p.clamp_min(1e-12))).sum(dim=0)
+            accumulator.add(z0, z1, pred, {
+                'max_softmax': max_softmax,
+                'entropy': entropy,
+                'energy': energy[z0:z1],
+                'variance': variance[:, z0:z1].mean(dim=0),
+            })
+        result = accumulator.result()
+        result['scores']['n_views'] = n
+        return result
+
+
+def benchmark_tta(model, image_tensor, view_counts=(1, 2, 4, 8), memory_budget_gb=4.0):
+    """延迟随视图数 N 的变化，对比批量前向与逐视图前向
+
+    Returns:
+        list: [(n_views, batched_seconds, sequential_seconds), ...]
+    """
+    results = []
+    print(f"⏱️  TTA 基准: 输入 {tuple(image_tensor.shape)}, 内存预算 {memory_budget_gb} GB")
+    for n_views in view_counts:
+        views = make_views(n_views)
+        timings = []
+        for budget in (memory_budget_gb, 0.0):  # 0.0 -> 每批 1 个视图
+            predictor = TTAPredictor(model, views, memory_budget_gb=budget)
+            start = time.perf_counter()
+            predictor.predict(image_tensor)
+            timings.append(time.perf_counter() - start)
+        batch_size = TTAPredictor(model, views, memory_budget_gb).views_per_batch(image_tensor.shape)
+        print(f"  N={n_views}: 批量 {timings[0]:.2f}s (每批 {batch_size} 个视图), "
+              f"逐视图 {timings[1]:.2f}s, 每视图 {timings[0] / n_views:.2f}s")
+        results.append((n_views, timings[0], timings[1]))
+    return results
+
+
+if __name__ == "__main__":
+    from kits23_unet_fixed import KITS23UNetFixed
+
+    model = KITS23UNetFixed().eval()
+    benchmark_tta(model, torch.rand(1, 64, 128, 128))